@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import numpy as np
+from scipy import sparse
+from kmeans import MiniBatchKMeans, normalize_rows, document_rows
+
+class IVFIndex:
+    """ Approximate nearest neighbor (cosine) index over the semantic
+    space, as an inverted file (IVF).
+    The space is split in cells, one per centroid (e.g. the K-Means
+    centroids of the model), and every document is stored in the cell
+    of its closest centroid. A query is only compared against the
+    documents of its 'probes' closest cells: more probes means better
+    recall and slower queries, probes equal to the number of cells is an
+    exact search.
+    """
+
+    # cells x dimensions, unit length
+    centroids = None
+
+    # documents x dimensions, unit length, in insertion order: the ones
+    # loaded with load_index (memory-mapped) and then the added ones, in
+    # a buffer that doubles its capacity when it is full
+    base = None
+    buffer = None
+    size = 0
+
+    # the cell of every document, loaded and added (a doubling buffer),
+    # and the ids of every cell as a list of arrays, joined when read
+    loaded_labels = None
+    label_buffer = None
+    cells = []
+
+    probes = 8
+
+    def __init__(self, centroids, probes=8):
+        self.centroids = normalize_rows(np.asarray(centroids, dtype=float))
+        self.base = np.empty((0, self.centroids.shape[1]))
+        self.buffer = np.empty((0, self.centroids.shape[1]))
+        self.size = 0
+        self.loaded_labels = np.empty(0, dtype=int)
+        self.label_buffer = np.empty(0, dtype=int)
+        self.cells = [[] for c in xrange(0, len(self.centroids))]
+        self.probes = probes
+
+    def __len__(self):
+        return len(self.base) + self.size
+
+    def add(self, sem_space):
+        """ Inserts documents (the columns of a semantic space, as in
+        LSI.sem_space or LSI.transform) and returns their ids, which
+        follow the ones already in the index.
+        Only the new documents are copied (amortized), the loaded ones
+        stay memory-mapped.
+        """
+
+        vectors = normalize_rows(document_rows(sem_space))
+        count = len(vectors)
+        first = len(self)
+        ids = np.arange(first, first + count)
+
+        labels = np.dot(vectors, self.centroids.T).argmax(axis=1)
+
+        self.reserve(self.size + count)
+        self.buffer[self.size:self.size + count] = vectors
+        self.label_buffer[self.size:self.size + count] = labels
+        self.size += count
+
+        for cell, cell_ids in group_by_cell(labels, len(self.centroids), ids):
+            self.cells[cell].append(cell_ids)
+
+        return ids
+
+    def reserve(self, size):
+        """ makes room for 'size' added documents, at least doubling """
+
+        if size <= len(self.buffer):
+            return
+
+        capacity = max(size, 2 * len(self.buffer))
+
+        buffer = np.empty((capacity, self.buffer.shape[1]))
+        buffer[0:self.size] = self.buffer[0:self.size]
+        self.buffer = buffer
+
+        label_buffer = np.empty(capacity, dtype=int)
+        label_buffer[0:self.size] = self.label_buffer[0:self.size]
+        self.label_buffer = label_buffer
+
+    def cell(self, cell):
+        """ the ids of the documents of a cell, joining its parts """
+
+        parts = self.cells[cell]
+
+        if len(parts) == 0:
+            return np.empty(0, dtype=int)
+        if len(parts) > 1:
+            self.cells[cell] = parts = [np.concatenate(parts)]
+
+        return parts[0]
+
+    def rows(self, ids):
+        """ the vectors of the given documents """
+
+        loaded = len(self.base)
+        in_base = ids < loaded
+
+        if in_base.all():
+            return self.base[ids]
+
+        rows = np.empty((len(ids), self.buffer.shape[1]))
+        rows[in_base] = self.base[ids[in_base]]
+        rows[~in_base] = self.buffer[ids[~in_base] - loaded]
+
+        return rows
+
+    def labels(self):
+        """ the cell of every document, in id order """
+
+        return np.concatenate([self.loaded_labels, self.label_buffer[0:self.size]])
+
+    def search(self, sem_space, top=10, probes=None):
+        """ Finds the 'top' most similar documents of every query (the
+        columns of a semantic space, or a single vector) looking in the
+        'probes' closest cells (by default the probes of the index).
+        Returns a list of (id, similarity) pairs per query, most similar
+        first.
+        """
+
+        if probes is None:
+            probes = self.probes
+        probes = max(1, min(probes, len(self.centroids)))
+
+        if not sparse.issparse(sem_space) and np.ndim(sem_space) == 1:
+            # a single query vector
+            sem_space = np.asarray(sem_space)[:, np.newaxis]
+
+        queries = normalize_rows(document_rows(sem_space))
+        cell_similarities = np.dot(queries, self.centroids.T)
+
+        results = []
+
+        for query, similarities in zip(queries, cell_similarities):
+            closest_cells = np.argpartition(-similarities, probes - 1)[0:probes]
+            candidates = np.concatenate([self.cell(cell) for cell in closest_cells])
+
+            scores = np.dot(self.rows(candidates), query)
+            results.append([(int(candidates[index]), similarity)
+                            for index, similarity in top_similar(scores, top)])
+
+        return results
+
+    def save(self, path):
+        """ Writes the index to the 'path' directory. The vectors are
+        written in chunks, to a new file that replaces the old one, so
+        the index can be saved where it was loaded from.
+        """
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'labels.npy'), self.labels())
+
+        vectors_path = os.path.join(path, 'vectors.npy')
+        vectors = np.lib.format.open_memmap(vectors_path + '.tmp', mode='w+',
+                                            shape=(len(self), self.centroids.shape[1]))
+
+        loaded = len(self.base)
+        for start in xrange(0, loaded, 100000):
+            end = min(start + 100000, loaded)
+            vectors[start:end] = self.base[start:end]
+        vectors[loaded:] = self.buffer[0:self.size]
+
+        vectors.flush()
+        del vectors
+        os.rename(vectors_path + '.tmp', vectors_path)
+
+        meta_file = open(os.path.join(path, 'meta.json'), 'w')
+        json.dump({'probes': self.probes}, meta_file)
+        meta_file.close()
+
+def build_index(sem_space, centroids=None, cells=100, probes=8, seed=None):
+    """ Builds an IVF index over a semantic space. Without centroids
+    (e.g. KMeans.centroids) the cells are found with mini-batch K-Means.
+    """
+
+    if centroids is None:
+        centroids = MiniBatchKMeans(k=cells, seed=seed).fit(sem_space, epochs=1).centroids
+
+    index = IVFIndex(centroids, probes)
+    index.add(sem_space)
+
+    return index
+
+def load_index(path, mmap_mode='r'):
+    """ Loads an index saved with IVFIndex.save, the documents are
+    memory-mapped with 'mmap_mode' (None reads them into memory).
+    """
+
+    meta_file = open(os.path.join(path, 'meta.json'), 'r')
+    meta = json.load(meta_file)
+    meta_file.close()
+
+    index = IVFIndex(np.load(os.path.join(path, 'centroids.npy')), meta['probes'])
+    index.base = np.load(os.path.join(path, 'vectors.npy'), mmap_mode=mmap_mode)
+    index.loaded_labels = np.load(os.path.join(path, 'labels.npy'))
+
+    for cell, cell_ids in group_by_cell(index.loaded_labels, len(index.centroids)):
+        index.cells[cell].append(cell_ids)
+
+    return index
+
+def group_by_cell(labels, cells, ids=None):
+    """ (cell, ids) pairs of the non-empty cells, the ids (by default
+    the positions of the labels) keep their order within every cell.
+    """
+
+    if ids is None:
+        ids = np.arange(len(labels))
+
+    order = np.argsort(labels, kind='mergesort')
+    bounds = np.cumsum(np.bincount(labels, minlength=cells))
+
+    return [(cell, ids[part]) for cell, part in enumerate(np.split(order, bounds[:-1]))
+            if len(part) > 0]
+
+def top_similar(similarities, top):
+    """ (index, similarity) pairs of the 'top' highest similarities,
+    sorted. Only those are sorted, the rest is partitioned away.
+    """
+
+    top = min(top, len(similarities))
+    if top <= 0:
+        return []
+
+    best = np.argpartition(-similarities, top - 1)[0:top]
+    best = best[np.argsort(-similarities[best])]
+
+    return [(int(index), float(similarities[index])) for index in best
+            if similarities[index] != -np.inf]
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import json
+import random
+
+def read_tweets(path, chunk_size=65536):
+    """ Generator over the texts of the tweets in a corpus file.
+    The file is either a JSON array of tweets or JSON Lines (one tweet
+    per line), it is read incrementally so memory stays flat whatever
+    the size of the file. Tweets without a text are skipped.
+    """
+
+    corpus = codecs.open(path, 'r', 'utf-8')
+
+    try:
+        if first_char(corpus) == '[':
+            tweets = iter_json_array(corpus, chunk_size)
+        else:
+            tweets = iter_json_lines(corpus)
+
+        for tweet in tweets:
+            if isinstance(tweet, dict) and 'text' in tweet:
+                yield tweet['text']
+    finally:
+        corpus.close()
+
+def first_char(corpus):
+    """ returns the first non-blank character and rewinds the file """
+
+    char = corpus.read(1)
+    while char and char.isspace():
+        char = corpus.read(1)
+
+    corpus.seek(0)
+
+    return char
+
+def text_only(pairs):
+    """ object hook that keeps only the text of every JSON object,
+    so the fields we never use don't end up in memory
+    """
+    return dict(pair for pair in pairs if pair[0] == 'text')
+
+decoder = json.JSONDecoder(object_pairs_hook=text_only)
+
+def iter_json_lines(corpus):
+    """ Generator over the objects of a JSON Lines file """
+
+    for line in corpus:
+        line = line.strip()
+
+        if line:
+            yield decoder.decode(line)
+
+def iter_json_array(corpus, chunk_size=65536):
+    """ Generator over the elements of a JSON array, reading the file
+    in chunks and decoding one element at a time.
+    """
+
+    buffer = u''
+    position = 0
+    started = False
+    finished = False
+
+    while not finished:
+        chunk = corpus.read(chunk_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+
+        while True:
+            # skip blanks and separators between the elements
+            while position < len(buffer) and (buffer[position].isspace() or buffer[position] == ','):
+                position += 1
+
+            if position >= len(buffer):
+                break
+
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('The corpus is not a JSON array')
+                started = True
+                position += 1
+                continue
+
+            if buffer[position] == ']':
+                finished = True
+                break
+
+            try:
+                element, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if not chunk:
+                    raise
+                # the element continues in the next chunk
+                break
+
+            yield element
+
+        if not chunk:
+            break
+
+def reservoir_sample(items, samplesize, seed=None):
+    """ Picks 'samplesize' items uniformly at random in a single pass
+    (reservoir sampling), without knowing how many items there are.
+    The sample keeps the order of the items.
+    """
+
+    random_state = random.Random(seed)
+    reservoir = []
+
+    for position, item in enumerate(items):
+        if position < samplesize:
+            reservoir.append((position, item))
+        else:
+            slot = random_state.randint(0, position)
+            if slot < samplesize:
+                reservoir[slot] = (position, item)
+
+    reservoir.sort()
+
+    return [item for position, item in reservoir]
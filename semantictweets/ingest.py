@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import sys
+import threading
+import time
+from Queue import Queue, Empty
+from metrics import Metrics, LogSink
+from tokencorpus import TokenCorpus
+
+logger = logging.getLogger(__name__)
+
+# put in the queue by the reader when the source is exhausted
+END = object()
+
+class Pipeline:
+    """ Ingestion of a stream of tweets into a sink.
+    A reader thread takes the tweets from the source (e.g. the Twitter
+    stream) and puts them in a bounded queue, the writer takes them out
+    and writes them to the sink in batches. A batch is written when it
+    holds batch_size tweets or flush_seconds after the last one, so a
+    slow stream still gets written. A slow sink never stalls the reader
+    until the queue is full, then the reader waits (back-pressure).
+    Failed writes are retried up to 'retries' times, waiting 'backoff'
+    seconds and twice as long on every new attempt.
+    Every report_seconds an 'ingest' event (tweets written, rate, queue
+    depth, batches and retries) is sent to 'metrics'.
+    """
+
+    sink = None
+    queue = None
+
+    batch_size = 500
+    flush_seconds = 1.0
+    retries = 5
+    backoff = 0.5
+
+    metrics = None
+    report_seconds = 10.0
+
+    # totals of the last run
+    tweets = 0
+    batches = 0
+    retried = 0
+
+    def __init__(self, sink, batch_size=500, flush_seconds=1.0, queue_size=10000,
+                 retries=5, backoff=0.5, metrics=None, report_seconds=10.0):
+        self.sink = sink
+        self.queue = Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics or Metrics([LogSink()])
+        self.report_seconds = report_seconds
+        self.error = None
+
+    def run(self, source):
+        """ Writes every tweet of 'source' (any iterable) to the sink,
+        returns when the source is exhausted and everything is written.
+        If it is interrupted (Ctrl-C) the current batch is written first.
+        An error of the source is raised once the tweets read before it
+        are written.
+        """
+
+        self.tweets = 0
+        self.batches = 0
+        self.retried = 0
+        self.error = None
+
+        reader = threading.Thread(target=self.read, args=(source,))
+        reader.daemon = True
+        reader.start()
+
+        start = last_report = time.time()
+        reported = 0
+
+        batch = []
+        deadline = time.time() + self.flush_seconds
+
+        try:
+            while True:
+                try:
+                    tweet = self.queue.get(timeout=max(0.0, deadline - time.time()))
+                except Empty:
+                    tweet = None
+
+                if tweet is END:
+                    break
+
+                if tweet is not None:
+                    batch.append(tweet)
+
+                if len(batch) >= self.batch_size or time.time() >= deadline:
+                    self.flush(batch)
+                    batch = []
+                    deadline = time.time() + self.flush_seconds
+
+                if time.time() - last_report >= self.report_seconds:
+                    self.report(self.tweets - reported, time.time() - last_report, start)
+                    last_report, reported = time.time(), self.tweets
+        except KeyboardInterrupt:
+            # stopped by hand, keep what was already read
+            self.flush(batch)
+            raise
+
+        self.flush(batch)
+        self.report(self.tweets - reported, time.time() - last_report, start)
+
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def read(self, source):
+        """ the reader thread, puts the tweets of the source in the queue """
+
+        try:
+            for tweet in source:
+                self.queue.put(tweet)
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            self.queue.put(END)
+
+    def flush(self, batch):
+        """ writes a batch to the sink, retrying with exponential backoff """
+
+        if len(batch) == 0:
+            return
+
+        attempt = 0
+        while True:
+            try:
+                self.sink.write(batch)
+                break
+            except Exception:
+                if attempt >= self.retries:
+                    raise
+
+                wait = self.backoff * 2 ** attempt
+                logger.warning("writing %d tweets failed, retrying in %.1fs",
+                               len(batch), wait, exc_info=True)
+                time.sleep(wait)
+
+                attempt += 1
+                self.retried += 1
+
+        self.tweets += len(batch)
+        self.batches += 1
+
+    def report(self, tweets, seconds, start):
+        """ sends the ingest event, the rate is over the last 'seconds' """
+
+        self.metrics.emit({'event': 'ingest',
+                           'tweets': self.tweets,
+                           'rate': tweets / seconds if seconds > 0 else 0.0,
+                           'queue_depth': self.queue.qsize(),
+                           'queue_size': self.queue.maxsize,
+                           'batches': self.batches,
+                           'retries': self.retried,
+                           'seconds': time.time() - start})
+
+class MongoSink:
+    """ Bulk inserts the tweets into a MongoDB collection """
+
+    collection = None
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def write(self, tweets):
+        # insert() gives every tweet its _id before sending them, so when
+        # a batch is retried the tweets that made it are rejected as
+        # duplicates instead of being stored twice
+        from pymongo.errors import DuplicateKeyError
+
+        try:
+            self.collection.insert(tweets, continue_on_error=True)
+        except DuplicateKeyError:
+            pass
+
+class JSONLinesSink:
+    """ Appends the tweets to a JSON Lines file (one tweet per line),
+    a corpus that read_tweets() understands.
+    """
+
+    def __init__(self, path):
+        self.stream = open(path, 'a')
+
+    def write(self, tweets):
+        self.stream.write(''.join(json.dumps(tweet) + '\n' for tweet in tweets))
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+class TokenSink:
+    """ Appends the texts of the tweets to a binary TokenCorpus, already
+    tokenized. Tweets without a text are skipped.
+    """
+
+    corpus = None
+
+    def __init__(self, path):
+        self.corpus = TokenCorpus(path)
+
+    def write(self, tweets):
+        self.corpus.append([tweet['text'] for tweet in tweets
+                            if isinstance(tweet, dict) and 'text' in tweet])
+
+def replay(path, delay=0.0):
+    """ Generator over the tweets of a JSON Lines file, waiting 'delay'
+    seconds between them, a local stand-in for the Twitter stream.
+    """
+
+    corpus = open(path, 'r')
+
+    try:
+        for line in corpus:
+            line = line.strip()
+
+            if line:
+                if delay > 0:
+                    time.sleep(delay)
+                yield json.loads(line)
+    finally:
+        corpus.close()
@@ -1,70 +1,620 @@
 # -*- coding: utf-8 -*-
 
-from scipy import dot, mat, linalg, array, random, add
+from scipy import sparse
 from math import *
 from copy import copy
+import logging
+import time
+import numpy as np
+from multiprocessing import Pool
+
+logger = logging.getLogger(__name__)
 
 class KMeans:
     """ This class represents the K-Means clustering algorithm.
     It takes the semantic space from the LSI model and computes
     the clustering algorithm.
+    The documents are kept as one matrix (a row per document) which is
+    normalized once, so every assignment step is a single docs x k
+    product followed by an argmax.
     """
 
     dimensions = -1
     documents = []
 
+    # documents x dimensions, raw and scaled to unit length
+    space = None
+    normalized = None
+
+    # results of the last call to cluster(), the inertia is the sum of
+    # the cosine distances (1 - similarity) of the documents to their centroid
+    labels = None
+    centroids = None
+    inertia = None
+    iterations = 0
+
+    # document-centroid similarities computed and skipped by the last run
+    computations = 0
+    skipped = 0
+
+    # statistics of every run of the last fit_restarts()
+    restarts = []
+
+    # silhouette and inertia of every candidate of the last select_k()
+    k_scores = []
+
+    # how many documents are compared against the centroids at once,
+    # bounds the size of the docs x k similarity matrix
+    batch_size = 10000
+
     def __init__(self, sem_space):
 
         rows, cols = sem_space.shape
-        print "dimensions: %d" % rows
+        logger.info("dimensions: %d", rows)
         self.dimensions = rows
 
+        if sparse.issparse(sem_space):
+            # column slicing is cheap on CSC
+            sem_space = sparse.csc_matrix(sem_space)
+
+        self.space = document_rows(sem_space)
+        self.normalized = normalize_rows(self.space)
+
         self.documents = [Document(sem_space[:, c], c) for c in xrange(0,cols)]
 
 
-    def cluster(self, k=3, max_iter=10):
+    def cluster(self, k=3, max_iter=10, init='k-means++', seed=None, callback=None,
+                algorithm='lloyd', n_init=1, workers=1, centroids=None):
+        """ Perform K-Means algorithm and return the clusters.
+        See fit() for the parameters. With n_init > 1 it is run that many
+        times from different seeds, in 'workers' processes, and the run
+        with the lowest inertia is kept (see fit_restarts). Starting from
+        given 'centroids' there is a single run.
+        """
+
+        if n_init > 1 and centroids is not None:
+            logger.warning("starting from the given centroids, the %d restarts are skipped", n_init)
+            n_init = 1
+
+        if n_init > 1:
+            self.fit_restarts(k, max_iter, init, seed, algorithm, n_init, workers, callback)
+        else:
+            self.fit(k, max_iter, init, seed, callback, algorithm, centroids)
+
+        return self.make_clusters(self.labels, self.centroids)
+
+    def fit(self, k=3, max_iter=10, init='k-means++', seed=None, callback=None,
+            algorithm='lloyd', centroids=None):
         """ Perform K-Means algorithm.
         K is the number of clusters. It is done for a max of
-        max_iter iterations.
+        max_iter iterations, or until no document changes its cluster.
+        The seeds are chosen with 'init':
+            random    -- random centroids, ignoring the documents
+            k-means++ -- documents sampled far away from the chosen ones
+            k-means|| -- scalable k-means++ with a few oversampling rounds
+        Given 'centroids' (k x dimensions) it starts from them instead,
+        e.g. the ones found by select_k() on a sample.
+        Clusters left empty are reseeded with the documents farthest
+        from their centroids.
+        The assignment step is done with 'algorithm':
+            lloyd   -- every document against every centroid
+            hamerly -- same assignments, but documents whose bounds show
+                       they can't change cluster skip the comparisons
+        'callback' is called after every assignment with a dict of
+        statistics: iteration, inertia, changed (documents that moved to
+        another cluster), empty (clusters), computations and skipped
+        (document-centroid similarities) and seconds.
         """
 
-        # create a set of k random clusters as seeds
-        old_clusters = [None] * k # just a placeholder
-        clusters = self.random_clusters(k)
+        if algorithm == 'lloyd':
+            assigner = ExactAssigner(self.normalized, self.batch_size)
+        elif algorithm == 'hamerly':
+            assigner = HamerlyAssigner(self.normalized, self.batch_size)
+        else:
+            raise Exception('Unknown algorithm: %s' % algorithm)
+
+        if centroids is None:
+            centroids = self.seed_centroids(k, init, np.random.RandomState(seed))
+        else:
+            centroids = np.array(centroids, dtype=float)
+            k = len(centroids)
+        labels = None
 
         iter = 0
-        while (iter < max_iter) and not (old_clusters == clusters):
-            print "iteration %d..." % iter
-            # assign new clusters to old clusters
-            for i in xrange(0, k):
-                old_clusters[i] = copy(clusters[i])
-                clusters[i].documents = []
+        while iter < max_iter:
+            logger.debug("iteration %d...", iter)
+            start = time.time()
+            computations, skipped = assigner.computations, assigner.skipped
+
+            # assign every document to the cluster with the highest similarity
+            new_labels, similarities = assigner.assign(centroids)
+            self.inertia = float((1.0 - similarities).sum())
+
+            if callback is not None:
+                if labels is None:
+                    changed = len(new_labels)
+                else:
+                    changed = int((new_labels != labels).sum())
+
+                callback({'iteration': iter,
+                          'inertia': self.inertia,
+                          'changed': changed,
+                          'empty': int((np.bincount(new_labels, minlength=k) == 0).sum()),
+                          'computations': assigner.computations - computations,
+                          'skipped': assigner.skipped - skipped,
+                          'seconds': time.time() - start})
+
+            if labels is not None and (new_labels == labels).all():
+                break
+
+            labels = new_labels
+
+            # update cluster means
+            centroids = self.update_centroids(labels, centroids)
+            centroids = self.reseed_empty(labels, similarities, centroids)
+
+            iter += 1
 
-            # for each document
-            for document in self.documents:
+        self.labels = labels
+        self.centroids = centroids
+        self.iterations = iter
+        self.computations = assigner.computations
+        self.skipped = assigner.skipped
+
+        return self
+
+    def fit_restarts(self, k=3, max_iter=10, init='k-means++', seed=None,
+                     algorithm='lloyd', n_init=10, workers=1, callback=None):
+        """ Runs fit() n_init times with different seeds (drawn from
+        'seed') and keeps the run with the lowest inertia.
+        The restarts run in a pool of 'workers' processes. The pool is
+        forked once the space is in place, so the workers read the
+        parent's (read-only) arrays through shared copy-on-write pages
+        instead of getting a copy each.
+        With a single worker 'callback' gets the statistics of every
+        iteration of every restart (see fit()), plus the restart number.
+        It can't be called from the pool, so it is ignored there.
+        The statistics of every restart are kept in self.restarts.
+        """
 
-                # determine the cluster with the highest similarity
-                similarities = [cosine_similarity(document, cluster) for cluster in old_clusters]
-                max_index = array(similarities).argmax()
+        global shared_kmeans
+
+        if callback is not None and workers > 1:
+            logger.warning("the callback is not called from %d workers, use workers=1 "
+                           "to follow the iterations", workers)
+
+        seeds = np.random.RandomState(seed).randint(2 ** 31 - 1, size=n_init)
+        tasks = [(k, max_iter, init, int(restart_seed), algorithm) for restart_seed in seeds]
+
+        shared_kmeans = self
+        try:
+            if workers > 1:
+                pool = Pool(min(workers, n_init))
+                try:
+                    results = pool.map(run_restart, tasks)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [run_restart(task, restart_callback(callback, restart))
+                           for restart, task in enumerate(tasks)]
+        finally:
+            shared_kmeans = None
+
+        self.restarts = []
+        for restart, (stats, labels, centroids) in enumerate(results):
+            stats['restart'] = restart
+            self.restarts.append(stats)
+
+        best = min(xrange(0, n_init), key=lambda restart: results[restart][0]['inertia'])
+        stats, labels, centroids = results[best]
+
+        self.labels = labels
+        self.centroids = centroids
+        self.inertia = stats['inertia']
+        self.iterations = stats['iterations']
+        self.computations = stats['computations']
+        self.skipped = stats['skipped']
+
+        logger.info("best of %d restarts: %d (inertia %.4f)", n_init, best, self.inertia)
+
+        return self
+
+    def seed_centroids(self, k, init, random_state):
+        """ Returns a k x dimensions array with the initial centroids """
+
+        if init == 'random':
+            # normally distributed around the origin, from the seed
+            return 10 * random_state.standard_normal((k, self.dimensions))
+
+        if k > self.normalized.shape[0]:
+            raise Exception('K must be smaller than the number of documents!')
+
+        if init == 'k-means++':
+            seeds = plus_plus(self.normalized, k, random_state)
+        elif init == 'k-means||':
+            seeds = kmeans_parallel(self.normalized, k, random_state, self.batch_size)
+        else:
+            raise Exception('Unknown initialization: %s' % init)
+
+        return dense_rows(self.space, seeds)
+
+    def add_centroids(self, centroids, count, random_state):
+        """ Adds 'count' k-means++ seeds to the given centroids, sampled
+        by their distance to the closest of them.
+        """
 
-                # assign document to that cluster
-                clusters[max_index].add(document)
+        labels, similarities = self.assign(centroids)
+        seeds = plus_plus(self.normalized, count, random_state,
+                          distances=np.maximum(1.0 - similarities, 0.0))
+
+        return np.vstack([centroids, dense_rows(self.space, seeds)])
+
+    def select_k(self, candidates=(10, 25, 50, 100, 200), sample_size=2000,
+                 max_iter=10, seed=None):
+        """ Chooses the number of clusters among the 'candidates' by the
+        mean silhouette of the clustering of a sample of 'sample_size'
+        documents. The candidates are fitted in increasing order, each
+        one starting from the centroids of the previous one plus new
+        k-means++ seeds, so they don't start from scratch.
+        Candidates the sample can't hold are left out. The scores are
+        kept in self.k_scores.
+        Returns the best k and its centroids, to start fit() with them.
+        """
 
-            # update cluster means
-            for cluster in clusters:
-                cluster.update_centroid()
-            
-            iter += 1
-            
-        return clusters
+        random_state = np.random.RandomState(seed)
+        docs = self.normalized.shape[0]
+
+        chosen = np.sort(random_state.permutation(docs)[0:sample_size])
+        sampled = KMeans(self.space[chosen].T)
+        sampled.batch_size = self.batch_size
+
+        candidates = sorted(set(k for k in candidates if 2 <= k < len(chosen)))
+        if len(candidates) == 0:
+            raise Exception('There are not enough documents for any candidate K!')
+
+        self.k_scores = []
+        best_score, best_k, best_centroids = None, None, None
+        centroids = None
 
-    def random_clusters(self, k):
-        clusters = []
+        for k in candidates:
+            if centroids is None:
+                centroids = sampled.seed_centroids(k, 'k-means++', random_state)
+            else:
+                centroids = sampled.add_centroids(centroids, k - len(centroids), random_state)
+
+            sampled.fit(k, max_iter, centroids=centroids)
+            centroids = sampled.centroids
+
+            score = silhouette(sampled.normalized, sampled.labels, k)
+            self.k_scores.append({'k': k,
+                                  'silhouette': score,
+                                  'inertia': sampled.inertia})
+            logger.info("k %d: silhouette %.4f, inertia %.4f", k, score, sampled.inertia)
+
+            if best_score is None or score > best_score:
+                best_score, best_k, best_centroids = score, k, centroids
+
+        return best_k, best_centroids
+
+    def assign(self, centroids):
+        """ Returns the index of the most similar (cosine) centroid
+        for every document, and that similarity.
+        """
+
+        return closest(self.normalized, normalize_rows(centroids), self.batch_size)
+
+    def reseed_empty(self, labels, similarities, centroids):
+        """ Moves the centroids of empty clusters to the documents that
+        are farthest from their own centroid.
+        """
+
+        counts = np.bincount(labels, minlength=len(centroids))
+        empty = np.nonzero(counts == 0)[0]
+
+        if len(empty) == 0:
+            return centroids
+
+        logger.debug("reseeding %d empty clusters...", len(empty))
+
+        farthest = np.argsort(similarities)[0:len(empty)]
+        centroids = centroids.copy()
+        centroids[empty[0:len(farthest)]] = dense_rows(self.space, farthest)
+
+        return centroids
+
+    def update_centroids(self, labels, centroids):
+        """ Computes the mean of every cluster as a grouped sum over
+        the labels. Empty clusters keep their previous centroid.
+        """
+
+        k = len(centroids)
+        docs = len(labels)
+
+        # k x docs indicator matrix, one non-zero per document
+        membership = sparse.csr_matrix((np.ones(docs), (labels, np.arange(docs))),
+                                       shape=(k, docs))
+        sums = membership.dot(self.space)
+        if sparse.issparse(sums):
+            sums = sums.toarray()
+        counts = np.bincount(labels, minlength=k)
+
+        new_centroids = centroids.copy()
+        filled = counts > 0
+        new_centroids[filled] = sums[filled] / counts[filled][:, np.newaxis]
+
+        return new_centroids
+
+    def make_clusters(self, labels, centroids):
+        """ Builds the Cluster objects from the labels """
+        return make_clusters(self.documents, labels, centroids)
+
+class MiniBatchKMeans:
+    """ Mini-batch (streaming) K-Means, after Sculley's web-scale K-Means.
+    Instead of going through every document on each iteration, the
+    centroids are updated from small batches of documents, each centroid
+    with its own learning rate (1 / documents seen by that centroid), so
+    it converges to the running mean of its documents.
+    Batches are columns of a semantic space like the one from LSI, they
+    can be fed all at once with fit() or as they arrive with partial_fit().
+    """
+
+    k = 0
+    dimensions = -1
+
+    # k x dimensions centroids and how many documents each one has seen
+    centroids = None
+    counts = None
+
+    batch_size = 1000
+    init = 'k-means++'
+    random_state = None
+
+    def __init__(self, k=3, batch_size=1000, init='k-means++', seed=None):
+        self.k = k
+        self.batch_size = batch_size
+        self.init = init
+        self.random_state = np.random.RandomState(seed)
+
+    def fit(self, sem_space, epochs=3):
+        """ Runs over the whole semantic space 'epochs' times, in
+        shuffled batches of batch_size documents.
+        """
+
+        if sparse.issparse(sem_space):
+            sem_space = sparse.csc_matrix(sem_space)
+
+        rows, cols = sem_space.shape
+
+        for epoch in xrange(0, epochs):
+            logger.debug("epoch %d...", epoch)
+            order = self.random_state.permutation(cols)
+
+            if self.centroids is None:
+                # seed from a sample large enough to hold every cluster
+                self.seed(sem_space[:, np.sort(order[0:max(self.batch_size, 3 * self.k)])])
+
+            for start in xrange(0, cols, self.batch_size):
+                batch = np.sort(order[start:start + self.batch_size])
+                self.partial_fit(sem_space[:, batch])
+
+        return self
+
+    def partial_fit(self, batch):
+        """ Updates the centroids with a batch of documents (columns).
+        The first batch is also used to seed the centroids.
+        """
+
+        if self.centroids is None:
+            self.seed(batch)
+
+        rows = document_rows(batch)
+        labels, similarities = closest(normalize_rows(rows), normalize_rows(self.centroids),
+                                       self.batch_size)
+
+        docs = len(labels)
+        membership = sparse.csr_matrix((np.ones(docs), (labels, np.arange(docs))),
+                                       shape=(self.k, docs))
+        sums = membership.dot(rows)
+        if sparse.issparse(sums):
+            sums = sums.toarray()
+        batch_counts = np.bincount(labels, minlength=self.k)
+
+        # per-centroid learning rate, the centroid moves towards the mean
+        # of its new documents by batch_count / total_count
+        self.counts += batch_counts
+        seen = batch_counts > 0
+        rates = batch_counts[seen] / self.counts[seen].astype(float)
+        means = sums[seen] / batch_counts[seen][:, np.newaxis]
+        self.centroids[seen] += rates[:, np.newaxis] * (means - self.centroids[seen])
+
+        # centroids that never got a document are moved to the
+        # documents of this batch that are farthest from their centroid
+        empty = np.nonzero(self.counts == 0)[0]
+        if len(empty) > 0:
+            farthest = np.argsort(similarities)[0:len(empty)]
+            self.centroids[empty[0:len(farthest)]] = dense_rows(rows, farthest)
+
+        return self
+
+    def seed(self, sem_space):
+        """ Chooses the initial centroids from the documents (columns) """
+
+        self.dimensions = sem_space.shape[0]
+        self.counts = np.zeros(self.k, dtype=int)
+
+        if self.init == 'random':
+            # normally distributed around the origin, from the seed
+            self.centroids = 10 * self.random_state.standard_normal((self.k, self.dimensions))
+            return
+
+        rows = document_rows(sem_space)
+        normalized = normalize_rows(rows)
+
+        if self.k > normalized.shape[0]:
+            raise Exception('K must be smaller than the number of documents in the batch!')
+
+        if self.init == 'k-means++':
+            seeds = plus_plus(normalized, self.k, self.random_state)
+        elif self.init == 'k-means||':
+            seeds = kmeans_parallel(normalized, self.k, self.random_state, self.batch_size)
+        else:
+            raise Exception('Unknown initialization: %s' % self.init)
+
+        self.centroids = dense_rows(rows, seeds)
+
+    def predict(self, sem_space):
+        """ Returns the closest centroid for every document (column) """
+
+        rows = document_rows(sem_space)
+        labels, similarities = closest(normalize_rows(rows), normalize_rows(self.centroids),
+                                       self.batch_size)
+        return labels
+
+    def cluster(self, sem_space, epochs=3):
+        """ Fits the semantic space and returns the clusters, like
+        KMeans.cluster does.
+        """
 
-        for i in range(0,k):
-            clusters.append(Cluster(i,self.dimensions))
+        self.fit(sem_space, epochs)
 
-        return clusters
+        if sparse.issparse(sem_space):
+            sem_space = sparse.csc_matrix(sem_space)
+
+        labels = self.predict(sem_space)
+        documents = [Document(sem_space[:, c], c) for c in xrange(0, sem_space.shape[1])]
+
+        return make_clusters(documents, labels, self.centroids)
+
+# the KMeans the restart workers run on, see KMeans.fit_restarts
+shared_kmeans = None
+
+def run_restart(task, callback=None):
+    """ One restart of KMeans.fit_restarts, on shared_kmeans.
+    Returns its statistics, labels and centroids.
+    """
+
+    k, max_iter, init, seed, algorithm = task
+
+    start = time.time()
+    shared_kmeans.fit(k, max_iter, init, seed, callback, algorithm)
+
+    stats = {'seed': seed,
+             'inertia': shared_kmeans.inertia,
+             'iterations': shared_kmeans.iterations,
+             'computations': shared_kmeans.computations,
+             'skipped': shared_kmeans.skipped,
+             'seconds': time.time() - start}
+
+    return stats, shared_kmeans.labels, shared_kmeans.centroids
+
+def restart_callback(callback, restart):
+    """ the fit() callback of a restart, the statistics get its number """
+
+    if callback is None:
+        return None
+
+    def restart_iteration(stats):
+        stats['restart'] = restart
+        callback(stats)
+
+    return restart_iteration
+
+class ExactAssigner:
+    """ Assignment step of Lloyd's K-Means, every document is compared
+    against every centroid.
+    """
+
+    # document-centroid similarities computed and skipped so far
+    computations = 0
+    skipped = 0
+
+    def __init__(self, normalized, batch_size=10000):
+        self.normalized = normalized
+        self.batch_size = batch_size
+        self.computations = 0
+        self.skipped = 0
+
+    def assign(self, centroids):
+        """ the closest centroid of every document, and the similarity """
+        self.computations += self.normalized.shape[0] * len(centroids)
+        return closest(self.normalized, normalize_rows(centroids), self.batch_size)
+
+class HamerlyAssigner:
+    """ Assignment step with Hamerly's bounds (Hamerly, 2010).
+    For unit vectors the most similar (cosine) centroid is also the
+    closest one in euclidean distance, so the triangle inequality holds.
+    Every document keeps a lower bound of the distance to its second
+    closest centroid, which shrinks by how much the centroids moved.
+    If the exact distance to its own centroid is below that bound, or
+    below half the distance to the nearest other centroid, it can't
+    change cluster and isn't compared against the other centroids.
+    The assignments are the same as with ExactAssigner.
+    """
+
+    computations = 0
+    skipped = 0
+
+    def __init__(self, normalized, batch_size=10000):
+        self.normalized = normalized
+        self.batch_size = batch_size
+        self.computations = 0
+        self.skipped = 0
+
+        # current labels, lower bounds and unit centroids of the last step
+        self.labels = None
+        self.lower = None
+        self.unit = None
+
+    def assign(self, centroids):
+        """ the closest centroid of every document, and the similarity """
+
+        unit = normalize_rows(centroids)
+        docs = self.normalized.shape[0]
+        k = len(unit)
+
+        if self.labels is None:
+            self.labels, similarities, second = best_two(self.normalized, unit, self.batch_size)
+            self.lower = distance(second)
+            self.computations += docs * k
+            self.unit = unit
+            return self.labels.copy(), similarities
+
+        # the second closest centroid got at most as close as the
+        # largest move of the other centroids
+        moved = np.sqrt(((unit - self.unit) ** 2).sum(axis=1))
+        if k > 1:
+            order = np.argsort(moved)
+            largest, runner_up = moved[order[-1]], moved[order[-2]]
+            self.lower -= np.where(self.labels == order[-1], runner_up, largest)
+
+        # exact distance to the current centroid
+        similarities = row_similarities(self.normalized, unit[self.labels])
+        upper = distance(similarities)
+
+        # half the distance from every centroid to the nearest other one
+        separation = distance(np.dot(unit, unit.T))
+        np.fill_diagonal(separation, np.inf)
+        half_nearest = 0.5 * separation.min(axis=1)
+
+        # a document right on the bound may be tied with another centroid,
+        # it's checked so ties go to the first centroid as in ExactAssigner
+        bound = np.maximum(half_nearest[self.labels], self.lower)
+        check = np.nonzero(upper >= bound)[0]
+
+        if len(check) > 0:
+            labels, best, second = best_two(self.normalized[check], unit, self.batch_size)
+            self.labels[check] = labels
+            similarities[check] = best
+            self.lower[check] = distance(second)
+
+        # the checked documents were already compared with their own centroid
+        computed = docs + len(check) * (k - 1)
+        self.computations += computed
+        self.skipped += docs * k - computed
+        self.unit = unit
+
+        return self.labels.copy(), similarities
 
 class Cluster:
     """ This class represents a cluster.
@@ -81,65 +631,265 @@ class Cluster:
     # the mean of the cluster
     centroid = None
 
-    def __init__(self, tag, dimensions):
+    def __init__(self, tag, centroid):
         self.index = tag
-        self.centroid = array(10*random.standard_normal(dimensions))
+        self.centroid = centroid
+        self.documents = []
 
     def add(self, document):
         self.documents.append(document)
 
-    def update_centroid(self):
-        """ Update the mean of the current cluster """
+class Document:
 
-        total_docs = len(self.documents)
+    # the internal model of the document
+    vector = None 
+    # for labeling the vectors
+    index = -1  
 
-        if total_docs == 0:
-            return
+    def __init__(self, vector, index):
+        if sparse.issparse(vector):
+            # keep sparse columns as sparse rows
+            self.vector = sparse.csr_matrix(vector.T)
+        else:
+            # a view, the semantic space is never modified
+            self.vector = vector.T
+        self.index = index
 
-        new_centroid = self.centroid.copy()
-        for document in self.documents:
-            new_centroid = new_centroid + document.vector
+def document_rows(sem_space):
+    """ The documents (columns) of a semantic space as the rows of a
+    dense array or a CSR matrix.
+    """
+    if sparse.issparse(sem_space):
+        return sparse.csr_matrix(sem_space.T)
+    return np.asarray(sem_space).T
 
-        self.centroid = new_centroid / float(total_docs)
+def dense_rows(matrix, indices):
+    """ dense copy of the given rows """
+    if sparse.issparse(matrix):
+        return matrix[indices].toarray()
+    return np.array(matrix[indices], dtype=float)
 
-    def __eq__(self, other):
-        """ Override rich comparison method.
-        It compares the indices of the documents in the self.documents list.
-        Returns True if the indices are the same in both documents lists, 
-        False otherwise.
-        """
+def make_clusters(documents, labels, centroids):
+    """ Builds the Cluster objects from the labels of the documents """
 
-        if not self or not other: #either one of them is null
-            return False
+    clusters = [Cluster(i, centroids[i].copy()) for i in xrange(0, len(centroids))]
 
-        if len(self.documents) != len(other.documents):
-            return False
+    for document in documents:
+        clusters[labels[document.index]].add(document)
 
-        for i in xrange(0, len(self.documents)):
-            if self.documents[i].index != other.documents[i].index:
-                return False
+    return clusters
 
-        return True
+def closest(normalized, targets, batch_size=10000):
+    """ For every row of 'normalized' finds the most similar (cosine) row
+    of 'targets', both scaled to unit length. The rows are compared in
+    batches to bound the size of the similarity matrix.
+    Returns the indices of the targets and the similarities.
+    """
 
-class Document:
+    docs = normalized.shape[0]
+    labels = np.empty(docs, dtype=int)
+    best = np.empty(docs)
 
-    # the internal model of the document
-    vector = None 
-    # for labeling the vectors
-    index = -1  
+    for start in xrange(0, docs, batch_size):
+        end = min(start + batch_size, docs)
+        similarities = normalized[start:end].dot(targets.T)
+        if sparse.issparse(similarities):
+            similarities = similarities.toarray()
+        similarities = np.asarray(similarities)
+        labels[start:end] = similarities.argmax(axis=1)
+        best[start:end] = similarities[np.arange(end - start), labels[start:end]]
 
-    def __init__(self, vector, index):
-        self.vector = vector.copy().T
-        self.index = index
+    return labels, best
+
+def best_two(normalized, targets, batch_size=10000):
+    """ Like closest, but also returns the similarity of every row to
+    its second most similar target (-inf if there is only one).
+    """
+
+    docs = normalized.shape[0]
+    labels = np.empty(docs, dtype=int)
+    best = np.empty(docs)
+    second = np.empty(docs)
+
+    for start in xrange(0, docs, batch_size):
+        end = min(start + batch_size, docs)
+        similarities = normalized[start:end].dot(targets.T)
+        if sparse.issparse(similarities):
+            similarities = similarities.toarray()
+        similarities = np.array(similarities, dtype=float)
+
+        rows = np.arange(end - start)
+        labels[start:end] = similarities.argmax(axis=1)
+        best[start:end] = similarities[rows, labels[start:end]]
+        similarities[rows, labels[start:end]] = -np.inf
+        second[start:end] = similarities.max(axis=1)
+
+    return labels, best, second
+
+def row_similarities(normalized, targets):
+    """ similarity of every row with the same row of 'targets' """
+
+    if sparse.issparse(normalized):
+        return np.asarray(normalized.multiply(targets).sum(axis=1)).ravel()
+    return (normalized * targets).sum(axis=1)
+
+def distance(similarities):
+    """ euclidean distance between unit vectors from their cosine """
+    return np.sqrt(np.maximum(2.0 - 2.0 * similarities, 0.0))
+
+def distances_to(normalized, index):
+    """ cosine distance (1 - similarity) of every row to the given row.
+    For unit vectors it is proportional to the squared euclidean distance.
+    """
+
+    similarities = normalized.dot(normalized[index].T)
+    if sparse.issparse(similarities):
+        similarities = similarities.toarray()
+
+    return np.maximum(1.0 - np.asarray(similarities).ravel(), 0.0)
+
+def silhouette(normalized, labels, k):
+    """ Mean silhouette of a clustering of unit length rows, with the
+    cosine distance. For every row 'a' is its mean distance to the rest
+    of its cluster and 'b' its lowest mean distance to another cluster,
+    its silhouette is (b - a) / max(a, b), 0 if it's alone in its cluster.
+    It builds the rows x rows distance matrix, so it's meant for samples.
+    """
+
+    docs = len(labels)
+    rows = np.arange(docs)
+
+    similarities = normalized.dot(normalized.T)
+    if sparse.issparse(similarities):
+        similarities = similarities.toarray()
+    distances = np.maximum(1.0 - np.asarray(similarities), 0.0)
+
+    # sum of the distances of every row to the rows of every cluster
+    membership = sparse.csr_matrix((np.ones(docs), (labels, rows)), shape=(k, docs))
+    sums = np.asarray(membership.dot(distances)).T
+    counts = np.bincount(labels, minlength=k)
+
+    own = counts[labels]
+    a = sums[rows, labels] / np.maximum(own - 1, 1)
+
+    means = np.full((docs, k), np.inf)
+    filled = counts > 0
+    means[:, filled] = sums[:, filled] / counts[filled]
+    means[rows, labels] = np.inf
+    b = means.min(axis=1)
+
+    scores = np.zeros(docs)
+    valid = (own > 1) & np.isfinite(b) & (np.maximum(a, b) > 0)
+    scores[valid] = (b[valid] - a[valid]) / np.maximum(a[valid], b[valid])
+
+    return float(scores.mean())
+
+def plus_plus(normalized, k, random_state, weights=None, distances=None):
+    """ k-means++ seeding over the rows of a unit length matrix.
+    Every new seed is sampled with probability proportional to its
+    (weighted) distance to the closest seed chosen so far.
+    To add seeds to existing centroids, 'distances' are the distances
+    of every row to the closest of them.
+    Returns the indices of the k seeds.
+    """
 
-def cosine_similarity(document, cluster):
-    """ Helper function for calculating cosine similarities between 
-    a document vector and a cluster centroid.
+    points = normalized.shape[0]
+    if weights is None:
+        weights = np.ones(points)
+
+    if distances is None:
+        seeds = [sample(weights, random_state)]
+        distances = distances_to(normalized, seeds[0])
+    else:
+        seeds = []
+
+    while len(seeds) < k:
+        seed = sample(weights * distances, random_state)
+
+        if seed is None:
+            # every point sits on a seed, pick any of the remaining ones
+            remaining = np.setdiff1d(np.arange(points), seeds)
+            seed = remaining[random_state.randint(len(remaining))]
+
+        seeds.append(seed)
+        distances = np.minimum(distances, distances_to(normalized, seed))
+
+    return np.array(seeds)
+
+def kmeans_parallel(normalized, k, random_state, batch_size=10000,
+                    oversampling=None, rounds=5):
+    """ k-means|| seeding (Bahmani et al.)
+    Instead of k sequential passes over the data it does a few rounds,
+    each one sampling about 'oversampling' (2k by default) candidates at
+    once. The candidates are weighted by how many points are closest to
+    them and reduced to k seeds with k-means++.
+    Returns the indices of the k seeds.
     """
-    num = dot(document.vector, cluster.centroid)
-    den = linalg.norm(document.vector) * linalg.norm(cluster.centroid)
 
-    return num / den
+    points = normalized.shape[0]
+    if oversampling is None:
+        oversampling = 2 * k
+
+    candidates = [random_state.randint(points)]
+    distances = distances_to(normalized, candidates[0])
+
+    for round in xrange(0, rounds):
+        total = distances.sum()
+        if total <= 0:
+            break
+
+        picked = np.nonzero(random_state.uniform(size=points) <
+                            oversampling * distances / total)[0]
+        if len(picked) == 0:
+            continue
+
+        candidates.extend(picked)
+        labels, similarities = closest(normalized, normalized[picked], batch_size)
+        distances = np.minimum(distances, np.maximum(1.0 - similarities, 0.0))
+
+    candidates = np.unique(candidates)
+
+    if len(candidates) < k:
+        # not enough candidates, top them up with random points
+        remaining = np.setdiff1d(np.arange(points), candidates)
+        extra = random_state.permutation(remaining)[0:k - len(candidates)]
+        candidates = np.union1d(candidates, extra)
+
+    # weight every candidate by the number of points closest to it
+    labels, similarities = closest(normalized, normalized[candidates], batch_size)
+    weights = np.bincount(labels, minlength=len(candidates)).astype(float)
+
+    seeds = plus_plus(normalized[candidates], k, random_state, weights)
+
+    return candidates[seeds]
+
+def sample(weights, random_state):
+    """ Samples an index with probability proportional to its weight,
+    None if all the weights are zero.
+    """
+
+    cumulative = np.cumsum(weights)
+    total = cumulative[-1]
+
+    if total <= 0:
+        return None
+
+    index = np.searchsorted(cumulative, random_state.uniform() * total, side='right')
+
+    return min(index, len(weights) - 1)
+
+def normalize_rows(matrix):
+    """ Scales every row of a (dense or sparse) matrix to unit length.
+    Rows of zeros are left as they are.
+    """
 
+    if sparse.issparse(matrix):
+        matrix = sparse.csr_matrix(matrix, dtype=float)
+        lengths = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        lengths[lengths == 0] = 1.0
+        return sparse.csr_matrix(sparse.diags(1.0 / lengths).dot(matrix))
 
-        
+    matrix = np.asarray(matrix, dtype=float)
+    lengths = np.sqrt((matrix * matrix).sum(axis=1))
+    lengths[lengths == 0] = 1.0
+    return matrix / lengths[:, np.newaxis]
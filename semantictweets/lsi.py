@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 
-from scipy import dot, mat, linalg, array
+from scipy import dot, mat, linalg, array, sparse, argsort
+from scipy.sparse.linalg import svds
 from math import *
 from pprint import pprint
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# term frequency weightings understood by tfidf()
+TFIDF_SCHEMES = ('raw', 'log', 'sublinear', 'l2')
 
 class LSI:
     """Latent Semantic Analysis (LSI) model.
@@ -14,46 +22,58 @@ class LSI:
 
     vspace = None
 
+    # idf weight of every term and the scheme used in compute_tfidf
+    idf = None
+    tfidf_scheme = None
+
     # results from the rank-reduced SVD
     sigma_k = None
     T_k = None
     D_k = None
 
+    # sum of the squared singular values of the whole space
+    total_energy = None
+
     # the semantic space is the representation we are going to use for
     # k-means, which is sigma_k * D_k
     sem_space = None
 
-    def __init__(self, vspace):
-        """ Initialize with the vspace obtained in previous step """
-        self.vspace = array(vspace)
+    # after update() D_k is kept factored (Brand) as W * [blocks], a
+    # k x k rotation and the columns of D_k before any update followed by
+    # the ones of every new block, see materialize()
+    W = None
+    D_blocks = None
+
+    def __init__(self, vspace=None):
+        """ Initialize with the vspace obtained in previous step.
+        A sparse matrix is kept sparse, anything else is turned into
+        a dense array. Without a vspace the model is empty, e.g. to be
+        filled with the factors of a saved model.
+        """
+        if vspace is None:
+            return
+        elif sparse.issparse(vspace):
+            self.vspace = sparse.csr_matrix(vspace, dtype=float)
+        else:
+            self.vspace = array(vspace, dtype=float)
 
-    def compute_tfidf(self):
+    def compute_tfidf(self, scheme='raw'):
         """ Transforms the current space to a tf*idf matrix for 
         better results.
+        The document frequencies are counted once per term and the
+        weights are applied to the whole matrix at once, see tfidf()
+        for the available schemes.
         """
 
-        docs, terms = self.vspace.shape
-        docs_total = len(self.vspace)
-        
-        for doc in xrange(0, docs): 
-            # iterate over documents
-            
-            # count words in a doc
-            words_in_doc = reduce(lambda x, y: x + y, self.vspace[doc])
+        if scheme not in TFIDF_SCHEMES:
+            raise Exception('Unknown tf*idf scheme: %s' % scheme)
 
-            for term in xrange(0, terms):
-                # iterate over terms in document
+        self.idf = inverse_document_frequency(self.vspace)
+        self.tfidf_scheme = scheme
+        self.vspace = tfidf(self.vspace, self.idf, scheme)
 
-                if self.vspace[doc][term] != 0:
-
-                    # in how many docs does the term appear?
-                    term_occurrences = self.term_occurence(term)
-
-                    term_freq = float(self.vspace[doc][term]) / float(words_in_doc)
-                    inv_doc_freq = log(abs(docs_total / term_occurrences))
-                    self.vspace[doc][term] = term_freq * inv_doc_freq
-                
-    def rank_reduced_svd(self, k=3):
+    def rank_reduced_svd(self, k=3, solver=None, reconstruct=False,
+                         n_iter=4, oversamples=10, seed=None):
         """ Computes the rank reduced SVD.
         This method computes the SVD of a truncated space for the K highest
         singular values of sigma.
@@ -64,92 +84,412 @@ class LSI:
         An additional step is to compute the semantic space for the documents,
         which is multiplying Sigma_k * D_k, which will be used by K-Means to
         cluster the documents by similarity of terms.
+
+        The solver decides how the triplets are computed:
+            full       -- regular dense SVD, then truncated
+            arpack     -- Lanczos (ARPACK), only the top K triplets
+            randomized -- randomized range finder with n_iter power
+                          iterations and 'oversamples' extra columns
+        By default sparse spaces use arpack and dense ones the full SVD.
+        The rank-reduced space T_k * S * D_k is a dense terms x docs matrix,
+        it only replaces vspace when 'reconstruct' is set.
         """
 
         rows, cols = self.vspace.T.shape
 
-        if k <= rows: # vspace must be truncatable, i.e. k > num_docs
+        # squared frobenius norm, the sum of all the squared singular values
+        if sparse.issparse(self.vspace):
+            self.total_energy = float((self.vspace.data ** 2).sum())
+        else:
+            self.total_energy = float((np.asarray(self.vspace) ** 2).sum())
+
+        if solver is None:
+            solver = 'arpack' if sparse.issparse(self.vspace) else 'full'
+
+        if solver == 'full':
+            if k > min(rows, cols):
+                raise Exception('K must be smaller than the number of terms!')
+
+            space = self.vspace.T
+            if sparse.issparse(space):
+                space = space.toarray()
 
             # compute the regular SVD
             # use the transpose to get the form of X as it is usual
             # with document vectors and term rows
-            U, s, VT = linalg.svd(self.vspace.T) 
-
-            
-            # one approach is to truncate the SVD and then multiplying
-            # truncating has the advantage of being computationally simpler
-            # we just slice sigma
-            self.sigma_k = s[0:k].copy() # in numpy slices are by reference
-            self.T_k = U[:,0:k].copy() # eliminate last columns
-            self.D_k = VT[0:k].copy() # eliminate last rows
-
-#            print "Sigmas: " 
-#            print str(s)
-#            print str(self.sigma_k)
-#
-#            print "Terms: "
-#            print prettify(U)
-#            print prettify(self.T_k)
-#
-#            print "Documents: "
-#            print prettify(VT)
-#            print prettify(self.D_k)
-
-            S = linalg.diagsvd(self.sigma_k, k, k)
-            reduced_space = dot(dot(self.T_k, S), self.D_k)
-
-            self.sem_space = dot(S, self.D_k)
-
-#            # the other approach is to zero out the lowest values of sigma
-#            # conveniently scipy already sorts the singular values
-#            # zeroing out the lowest values of sigma produces
-#            for i in xrange(rows - k, rows):
-#                s[i] = 0
-#
-#            # compute reduced matrix to obtain the rank-reduced vector space
-#            S = linalg.diagsvd(s, len(self.vspace), len(VT))
-#            reduced_space = dot(dot(U, S), VT)
-#            self.sem_space = dot(S, VT)
-
-            self.vspace = reduced_space
-            
+            U, s, VT = linalg.svd(space, full_matrices=False)
+
+        elif solver == 'arpack':
+            if k >= min(rows, cols):
+                raise Exception('K must be smaller than the number of terms and documents!')
+
+            U, s, VT = svds(self.vspace.T, k=k)
+
+            # svds doesn't guarantee any order, sort by decreasing singular value
+            order = argsort(s)[::-1]
+            U, s, VT = U[:, order], s[order], VT[order]
+
+        elif solver == 'randomized':
+            if k > min(rows, cols):
+                raise Exception('K must be smaller than the number of terms!')
+
+            U, s, VT = randomized_svd(self.vspace.T, k, n_iter, oversamples, seed)
 
         else:
-            raise Exception('K must be smaller than the number of terms!')
+            raise Exception('Unknown SVD solver: %s' % solver)
+
+        # truncating the SVD has the advantage of being computationally
+        # simpler, we just slice sigma
+        self.sigma_k = s[0:k].copy() # in numpy slices are by reference
+        self.T_k = U[:,0:k].copy() # eliminate last columns
+        self.D_k = VT[0:k].copy() # eliminate last rows
+
+        S = linalg.diagsvd(self.sigma_k, k, k)
+        self.sem_space = dot(S, self.D_k)
+        self.W = None
+        self.D_blocks = None
+
+        if reconstruct:
+            self.vspace = dot(dot(self.T_k, S), self.D_k)
+
+    def select_rank(self, rule='gap', energy=0.8, min_rank=10):
+        """ Chooses the rank from the SVD already computed with 'rule':
+            gap    -- the rank before the largest relative drop between
+                      consecutive singular values (sigma_i / sigma_i+1),
+                      not below min_rank
+            energy -- the smallest rank whose singular values hold
+                      'energy' of the total (squared) energy of the space
+        tf*idf spaces of tweets spread their energy over thousands of
+        dimensions, so the energy rule often needs more triplets than
+        were computed, then all of them are kept and a warning is logged.
+        The factors are truncated to it, returns the rank.
+        """
 
+        sigma = np.asarray(self.sigma_k)
+        computed = len(sigma)
+
+        if rule == 'gap':
+            if computed <= min_rank:
+                rank = computed
+            else:
+                gaps = sigma[min_rank - 1:-1] / np.maximum(sigma[min_rank:], np.finfo(float).tiny)
+                rank = int(np.argmax(gaps)) + min_rank
+        elif rule == 'energy':
+            cumulative = np.cumsum(sigma ** 2) / self.total_energy
+            rank = min(int(np.searchsorted(cumulative, energy)) + 1, computed)
+
+            if cumulative[-1] < energy:
+                logger.warning("the %d singular values computed hold %.2f of the energy, "
+                               "less than %.2f, keeping all of them", computed,
+                               cumulative[-1], energy)
+        else:
+            raise Exception('Unknown rank rule: %s' % rule)
 
+        self.truncate(rank)
 
-    
-    def term_occurence(self, term):
-        """ computes in how many documents the term appears """
+        return rank
 
-        occurrences = 0
+    def truncate(self, rank):
+        """ keeps the first 'rank' singular triplets """
 
-        docs, terms = self.vspace.shape
+        self.materialize()
 
-        for doc in xrange(0, docs):
+        self.sigma_k = self.sigma_k[0:rank].copy()
+        self.T_k = self.T_k[:, 0:rank].copy()
+        self.D_k = self.D_k[0:rank].copy()
+        self.sem_space = self.sem_space[0:rank].copy()
 
-            if self.vspace[doc][term] != 0:
-                # the term is in the document
-                occurrences += 1.0 # use floats for convenience
+    def transform(self, space, batch_size=10000):
+        """ Projects new documents into the semantic space (fold-in),
+        without recomputing the SVD.
+        'space' is a documents x terms count matrix built with the same
+        vocabulary, e.g. with VSpace.vectorize(). It is weighted with the
+        stored idf and tf*idf scheme and projected through T_k, in batches
+        of documents. Returns a k x documents matrix comparable to the
+        columns of sem_space (sigma_k * D_k).
+        """
 
-        return occurrences
+        docs = space.shape[0]
+        sem_space = np.empty((len(self.sigma_k), docs))
 
-    def __repr__(self,):
-        """ pretty print """
-        rep = ""
-         
-        rows,cols = self.vspace.shape
-         
-        for row in xrange(0,rows):
-            rep += "["
-         
-            for col in xrange(0,cols):
-                rep += "%+0.2f "%self.vspace[row][col]
+        if sparse.issparse(space):
+            space = sparse.csr_matrix(space, dtype=float)
+        else:
+            space = np.asarray(space, dtype=float)
 
-            rep += "]\n"
-         
-        return rep
+        for start in xrange(0, docs, batch_size):
+            end = min(start + batch_size, docs)
+            batch = space[start:end]
+
+            if self.idf is not None:
+                batch = tfidf(batch, self.idf, self.tfidf_scheme)
+
+            # T_k' * x is sigma_k * d for a document in the space
+            sem_space[:, start:end] = np.asarray(batch.dot(self.T_k)).T
+
+        return sem_space
+
+    def fold_in(self, space, batch_size=10000):
+        """ Like transform, but the new documents are also appended to
+        D_k and sem_space. Returns their semantic space.
+        """
+
+        new_space = self.transform(space, batch_size)
+
+        self.materialize()
+        self.D_k = np.hstack([self.D_k, new_space / self.sigma_k[:, np.newaxis]])
+        if self.sem_space is not None:
+            self.sem_space = np.hstack([self.sem_space, new_space])
+
+        return new_space
+
+    def update(self, space, batch_size=100):
+        """ Incremental rank-k SVD update with new documents (Brand, 2006).
+        'space' is a documents x terms count matrix, like the one given by
+        VSpace.vectorize(docs, add_terms=True): its first columns are the
+        terms of the model and any extra columns are new terms.
+        New terms get their idf from the new documents (the weights of the
+        known terms stay as they are) and are added as rows of zeros for
+        the documents already in the model.
+        The factors are updated with blocks of 'batch_size' documents.
+        Every block only needs a QR and an SVD of (k + block) x (k + block)
+        matrices and products with T_k, never the documents already in
+        the model: D_k is kept factored as a k x k rotation of its old
+        columns, and the new documents are only appended (Brand's form).
+        D_k and sem_space are set to None until materialize() is called.
+        Every block is a dense terms x batch_size matrix, 8 bytes per
+        entry (80MB for 100k terms and the default batch_size).
+        Returns the semantic space of the new documents.
+        """
+
+        terms, k = self.T_k.shape
+        new_docs, total_terms = space.shape
+
+        space = sparse.csr_matrix(space, dtype=float)
+
+        if self.W is None:
+            self.W = np.eye(k)
+            self.D_blocks = [np.asarray(self.D_k)]
+
+        docs = sum(block.shape[1] for block in self.D_blocks)
+
+        if self.idf is not None:
+            if total_terms > terms:
+                doc_freq = np.asarray(space.getnnz(axis=0)[terms:], dtype=float)
+                new_idf = np.zeros(total_terms - terms)
+                present = doc_freq > 0
+                new_idf[present] = np.log((docs + new_docs) / doc_freq[present])
+                self.idf = np.concatenate([self.idf, new_idf])
+
+            space = tfidf(space, self.idf, self.tfidf_scheme)
+
+        # new terms are new rows of T_k, zero for the known documents
+        T_k = np.vstack([self.T_k, np.zeros((total_terms - terms, k))])
+        sigma_k = np.asarray(self.sigma_k)
+        W = self.W
+        blocks = []
+
+        for start in xrange(0, new_docs, batch_size):
+            # terms x block, in the usual LSI form
+            columns = space[start:start + batch_size].T.toarray()
+            T_k, sigma_k, rotation, new_columns = brand_update(T_k, sigma_k, columns)
+
+            # the new columns are stored so that W times them gives them back
+            W = dot(rotation, W)
+            blocks.append(dot(linalg.pinv(W), new_columns))
+
+        self.T_k = T_k
+        self.sigma_k = sigma_k
+        self.W = W
+        self.D_blocks.extend(blocks)
+        self.D_k = None
+        self.sem_space = None
+
+        return sigma_k[:, np.newaxis] * dot(W, np.hstack(blocks))
+
+    def materialize(self):
+        """ Multiplies out D_k (and sem_space) when update() left it
+        factored, the cost is a k x k by k x docs product.
+        """
+
+        if self.W is None:
+            return
+
+        k = len(self.sigma_k)
+        self.D_k = dot(self.W, np.hstack(self.D_blocks))
+        self.sem_space = dot(linalg.diagsvd(self.sigma_k, k, k), self.D_k)
+        self.W = None
+        self.D_blocks = None
+
+    def top_terms(self, dimension, top=10):
+        """ Returns (column, weight) pairs of the 'top' terms with the
+        largest (absolute) weight in a dimension of the semantic space,
+        the columns are turned into terms with VSpace.column_terms.
+        """
+
+        weights = np.asarray(self.T_k[:, dimension])
+        columns = np.argsort(-np.abs(weights))[0:top]
+
+        return [(int(column), float(weights[column])) for column in columns]
+
+    def __repr__(self):
+        """ pretty print of the space, a row at a time """
+
+        if self.vspace is None:
+            return "LSI()"
+
+        rep = []
+
+        for row in xrange(0, self.vspace.shape[0]):
+            if sparse.issparse(self.vspace):
+                values = self.vspace[row].toarray()[0]
+            else:
+                values = self.vspace[row]
+
+            rep.append("[" + "".join("%+0.2f " % value for value in values) + "]\n")
+
+        return "".join(rep)
+
+def brand_update(T_k, sigma_k, columns):
+    """ Adds new columns (terms x new docs) to the rank-k SVD
+    T_k * diag(sigma_k) * D_k.
+    The part of the columns outside the span of T_k is orthogonalized
+    with a QR, and only the small (k + c) x (k + c) core matrix
+        [ diag(sigma_k)   T_k' * columns ]
+        [ 0               R              ]
+    is decomposed, its singular vectors rotate the old factors.
+    Returns the new T_k and sigma_k, the k x k rotation of the old
+    columns of D_k and the k x c new columns, the new D_k is
+    [rotation * D_k, new columns].
+    """
+
+    k = len(sigma_k)
+    new_docs = columns.shape[1]
+
+    # projection on the current term space and what's left
+    M = dot(T_k.T, columns)
+    P, R = linalg.qr(columns - dot(T_k, M), mode='economic')
+
+    core = np.zeros((k + new_docs, k + new_docs))
+    core[0:k, 0:k] = np.diag(sigma_k)
+    core[0:k, k:] = M
+    core[k:, k:] = R
+
+    U_c, s_c, VT_c = linalg.svd(core)
+
+    T_k = dot(np.hstack([T_k, P]), U_c[:, 0:k])
+
+    return T_k, s_c[0:k].copy(), VT_c[0:k, 0:k], VT_c[0:k, k:]
+
+def randomized_svd(matrix, k, n_iter=4, oversamples=10, seed=None):
+    """ Approximates the K highest singular triplets of a (dense or sparse)
+    matrix with a randomized range finder (Halko, Martinsson & Tropp).
+    The matrix is only touched through products, so it is never densified.
+    Power iterations sharpen the approximation when the spectrum decays
+    slowly, as it does for term-document matrices.
+    """
+
+    rows, cols = matrix.shape
+    random_state = np.random.RandomState(seed)
+    samples = min(k + oversamples, rows, cols)
+
+    # orthonormal basis for the range of the matrix
+    Q = matrix.dot(random_state.standard_normal((cols, samples)))
+    Q, _ = linalg.qr(Q, mode='economic')
+
+    for i in xrange(0, n_iter):
+        Z, _ = linalg.qr(matrix.T.dot(Q), mode='economic')
+        Q, _ = linalg.qr(matrix.dot(Z), mode='economic')
+
+    # project onto the basis and decompose the small matrix
+    B = matrix.T.dot(Q).T
+    U_b, s, VT = linalg.svd(B, full_matrices=False)
+    U = dot(Q, U_b)
+
+    return U[:, 0:k], s[0:k], VT[0:k]
+
+def inverse_document_frequency(space):
+    """ Computes log(docs / df) for every term (column) of a
+    documents x terms matrix. Terms that appear in no document get 0.
+    """
+
+    docs, terms = space.shape
+
+    if sparse.issparse(space):
+        doc_freq = sparse.csc_matrix(space).getnnz(axis=0)
+    else:
+        doc_freq = (np.asarray(space) != 0).sum(axis=0)
+
+    doc_freq = np.asarray(doc_freq, dtype=float)
+    idf = np.zeros(terms)
+    present = doc_freq > 0
+    idf[present] = np.log(docs / doc_freq[present])
+
+    return idf
+
+def tfidf(space, idf, scheme='raw'):
+    """ Weights a documents x terms count matrix with the given idf.
+    The term frequency depends on the scheme:
+        raw       -- count / words in the document
+        log       -- log(1 + count)
+        sublinear -- 1 + log(count)
+        l2        -- like raw, then every document is scaled to unit length
+    A sparse matrix stays sparse (CSR), anything else is returned as a
+    dense array.
+    """
+
+    if sparse.issparse(space):
+        weighted = sparse.csr_matrix(space, dtype=float, copy=True)
+        values = weighted.data
+    else:
+        weighted = np.array(space, dtype=float)
+        values = weighted[weighted != 0]
+
+    # signed counts (see HashingVSpace) are weighted by their magnitude
+    signs = np.sign(values)
+    values = np.abs(values)
+
+    if scheme == 'log':
+        values = np.log1p(values)
+    elif scheme == 'sublinear':
+        values = 1.0 + np.log(values)
+
+    values = signs * values
+
+    if sparse.issparse(weighted):
+        weighted.data = values
+    else:
+        weighted[weighted != 0] = values
+
+    if scheme in ('raw', 'l2'):
+        # count words in every doc, empty docs are left alone
+        words_in_doc = np.asarray(abs(weighted).sum(axis=1), dtype=float).ravel()
+        words_in_doc[words_in_doc == 0] = 1.0
+        weighted = scale_rows(weighted, 1.0 / words_in_doc)
+
+    weighted = scale_columns(weighted, idf)
+
+    if scheme == 'l2':
+        if sparse.issparse(weighted):
+            lengths = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+        else:
+            lengths = np.sqrt((weighted * weighted).sum(axis=1))
+        lengths[lengths == 0] = 1.0
+        weighted = scale_rows(weighted, 1.0 / lengths)
+
+    return weighted
+
+def scale_rows(space, factors):
+    """ multiplies every row of the matrix by its factor """
+    if sparse.issparse(space):
+        return sparse.csr_matrix(sparse.diags(factors) * space)
+    return space * factors[:, np.newaxis]
+
+def scale_columns(space, factors):
+    """ multiplies every column of the matrix by its factor """
+    if sparse.issparse(space):
+        return sparse.csr_matrix(space * sparse.diags(factors))
+    return space * factors[np.newaxis, :]
 
 def prettify(array):
     rep = ""
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+class Metrics:
+    """ Instrumentation of a run of the model.
+    Every measurement is an event (a dict) handed to each callback:
+        stage     -- wall time, CPU time (this process and its finished
+                     children) and peak RSS of a stage of the pipeline
+        iteration -- the statistics of a K-Means iteration
+        ingest    -- tweets written, rate and queue depth of a Pipeline
+    Callbacks are any callable taking the event, e.g. LogSink or JSONSink.
+    """
+
+    callbacks = []
+
+    def __init__(self, callbacks=None):
+        self.callbacks = list(callbacks or [])
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def emit(self, event):
+        for callback in self.callbacks:
+            callback(event)
+
+    @contextmanager
+    def stage(self, name, **extra):
+        """ Measures the code in a with block as the stage 'name',
+        any keyword argument is added to the event.
+        """
+
+        monitor = PeakMemory()
+        monitor.start()
+
+        start_wall = time.time()
+        start_cpu = cpu_time()
+
+        try:
+            yield
+        finally:
+            cpu = cpu_time() - start_cpu
+            wall = time.time() - start_wall
+            peak = monitor.stop()
+
+            event = {'event': 'stage',
+                     'stage': name,
+                     'wall_seconds': wall,
+                     'cpu_seconds': cpu,
+                     'peak_rss_mb': peak / 1048576.0}
+            event.update(extra)
+            self.emit(event)
+
+    def iteration(self, stats):
+        """ reports the statistics of a K-Means iteration """
+        event = {'event': 'iteration'}
+        event.update(stats)
+        self.emit(event)
+
+class LogSink:
+    """ Callback that writes the events to a logger """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def __call__(self, event):
+        if event['event'] == 'stage':
+            self.logger.log(self.level, "%s: %.3fs (cpu %.3fs), peak %.1fMB",
+                            event['stage'], event['wall_seconds'],
+                            event['cpu_seconds'], event['peak_rss_mb'])
+        elif event['event'] == 'iteration':
+            self.logger.log(self.level, "iteration %d: inertia %.4f, %d changed, %d empty",
+                            event['iteration'], event['inertia'],
+                            event['changed'], event['empty'])
+        elif event['event'] == 'ingest':
+            self.logger.log(self.level, "ingest: %d tweets (%.1f/s), queue %d/%d, %d batches, %d retries",
+                            event['tweets'], event['rate'], event['queue_depth'],
+                            event['queue_size'], event['batches'], event['retries'])
+        else:
+            self.logger.log(self.level, "%s", event)
+
+class JSONSink:
+    """ Callback that writes every event as a line of JSON (JSON Lines),
+    with the time it was emitted, to a file or an open stream.
+    """
+
+    def __init__(self, output):
+        if isinstance(output, basestring):
+            self.stream = open(output, 'a')
+            self.owned = True
+        else:
+            self.stream = output
+            self.owned = False
+
+    def __call__(self, event):
+        event = dict(event, time=time.time())
+        self.stream.write(json.dumps(event) + '\n')
+        self.stream.flush()
+
+    def close(self):
+        if self.owned:
+            self.stream.close()
+
+def cpu_time():
+    """ user + system time of this process and its finished children """
+
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+
+    return total
+
+def current_rss():
+    """ resident memory of this process in bytes, 0 if unknown """
+
+    try:
+        statm = open('/proc/self/statm', 'r')
+        pages = int(statm.read().split()[1])
+        statm.close()
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return 0
+
+class PeakMemory(threading.Thread):
+    """ Samples the resident memory in the background and keeps the peak """
+
+    peak = 0
+
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import json
+import os
+import numpy as np
+from collections import OrderedDict
+from vspace import VSpace, HashingVSpace
+from lsi import LSI
+from kmeans import normalize_rows, document_rows
+
+class Model:
+    """ A trained model: the vocabulary of the VSpace, the factors of
+    the LSI (idf weights, T_k, sigma_k, D_k), the documents of its
+    semantic space as unit length rows and the K-Means centroids.
+    It is saved as a directory with one .npy file per array, a JSON
+    vocabulary and a small metadata file (for a HashingVSpace the buckets
+    and the sampled terms go in the metadata instead of a vocabulary).
+    Loading memory-maps the arrays, so it is almost instant and processes
+    loading the same model share a single copy of it (the OS page cache).
+    """
+
+    # the arrays of the model and the attribute of the LSI holding them
+    lsi_arrays = ('idf', 'T_k', 'sigma_k', 'D_k')
+
+    vspace = None
+    lsi = None
+    centroids = None
+
+    # documents x k, the columns of sem_space scaled to unit length, ready
+    # for the similarity queries
+    documents = None
+
+    def __init__(self, vspace=None, lsi=None, centroids=None, documents=None):
+        self.vspace = vspace
+        self.lsi = lsi
+        self.centroids = centroids
+        self.documents = documents
+
+    def save(self, path):
+        """ writes the model to the 'path' directory """
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # terms in id order
+        vocabulary = sorted(self.vspace.term_index, key=self.vspace.term_index.get)
+        vocabulary_file = codecs.open(os.path.join(path, 'vocabulary.json'), 'w', 'utf-8')
+        json.dump(vocabulary, vocabulary_file, ensure_ascii=False)
+        vocabulary_file.close()
+
+        # D_k may be factored after LSI.update()
+        self.lsi.materialize()
+
+        for name in self.lsi_arrays:
+            value = getattr(self.lsi, name)
+            if value is not None:
+                np.save(os.path.join(path, name + '.npy'), np.asarray(value))
+
+        if self.centroids is not None:
+            np.save(os.path.join(path, 'centroids.npy'), np.asarray(self.centroids))
+
+        documents = self.documents
+        if documents is None and self.lsi.sem_space is not None:
+            documents = normalize_rows(document_rows(self.lsi.sem_space))
+        if documents is not None:
+            np.save(os.path.join(path, 'documents.npy'), np.asarray(documents))
+
+        meta = {'tfidf_scheme': self.lsi.tfidf_scheme,
+                'terms': len(vocabulary),
+                'vectorizer': 'vocabulary'}
+
+        if isinstance(self.vspace, HashingVSpace):
+            meta.update({'vectorizer': 'hashing',
+                         'terms': self.vspace.buckets,
+                         'buckets': self.vspace.buckets,
+                         'sample_terms': self.vspace.sample_terms,
+                         'term_buckets': self.vspace.term_buckets.items()})
+
+        meta_file = open(os.path.join(path, 'meta.json'), 'w')
+        json.dump(meta, meta_file)
+        meta_file.close()
+
+def load_model(path, mmap_mode='r'):
+    """ Loads a model saved with Model.save.
+    The arrays are memory-mapped with 'mmap_mode' (None reads them
+    into memory). Files missing from the directory are left as None.
+    """
+
+    meta_file = open(os.path.join(path, 'meta.json'), 'r')
+    meta = json.load(meta_file)
+    meta_file.close()
+
+    vocabulary_file = codecs.open(os.path.join(path, 'vocabulary.json'), 'r', 'utf-8')
+    vocabulary = json.load(vocabulary_file)
+    vocabulary_file.close()
+
+    if meta.get('vectorizer') == 'hashing':
+        vspace = HashingVSpace(buckets=meta['buckets'], sample_terms=meta['sample_terms'])
+        vspace.term_buckets = OrderedDict((term, bucket) for term, bucket in meta['term_buckets'])
+    else:
+        vspace = VSpace()
+        vspace.term_index = dict((term, index) for index, term in enumerate(vocabulary))
+
+    lsi = LSI()
+    lsi.tfidf_scheme = meta['tfidf_scheme']
+
+    for name in Model.lsi_arrays:
+        setattr(lsi, name, load_array(path, name, mmap_mode))
+
+    return Model(vspace, lsi, load_array(path, 'centroids', mmap_mode),
+                 load_array(path, 'documents', mmap_mode))
+
+def load_array(path, name, mmap_mode='r'):
+    """ memory-maps the array 'name' of a model, None if it isn't there """
+
+    array_path = os.path.join(path, name + '.npy')
+
+    if not os.path.exists(array_path):
+        return None
+
+    return np.load(array_path, mmap_mode=mmap_mode)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+import numpy as np
+from scipy import sparse
+
+# output formats understood by write_report()
+REPORT_FORMATS = ('text', 'jsonl', 'csv')
+
+BAR = '*' * 150 + '\n'
+
+def write_report(clusters, tweets, path, format='text', index_path=None):
+    """ Writes the clusters to 'path', streaming them one by one so the
+    report is never held in memory. The formats are:
+        text  -- human readable, every cluster with its tweets
+        jsonl -- a JSON object per tweet (cluster, tweet, similarity, text)
+        csv   -- cluster_id, tweet_index, similarity
+    The clusters are numbered in the order they are given, the similarity
+    is the cosine between the tweet and its cluster centroid.
+    With 'index_path' it also writes a JSON object with the byte offset
+    and length of every cluster in the report, so a single cluster can be
+    read without scanning the file.
+    """
+
+    if format not in REPORT_FORMATS:
+        raise Exception('Unknown report format: %s' % format)
+
+    report = open(path, 'wb')
+    offsets = {}
+
+    if format == 'text':
+        report.write(BAR)
+    elif format == 'csv':
+        writer = csv.writer(report)
+        writer.writerow(['cluster_id', 'tweet_index', 'similarity'])
+
+    for c, cluster in enumerate(clusters):
+        start = report.tell()
+
+        if format == 'text':
+            report.write("* Cluster: %d. Total tweets: %d\n" % (c, len(cluster.documents)))
+
+            for document in cluster.documents:
+                report.write(("*   tweet: %s\n" % tweets[document.index]).encode('utf-8'))
+
+            report.write(BAR)
+
+        else:
+            similarities = centroid_similarities(cluster)
+
+            for document, similarity in zip(cluster.documents, similarities):
+                if format == 'jsonl':
+                    report.write(json.dumps({'cluster': c,
+                                             'tweet': document.index,
+                                             'similarity': similarity,
+                                             'text': tweets[document.index]}))
+                    report.write('\n')
+                else:
+                    writer.writerow([c, document.index, repr(similarity)])
+
+        offsets[c] = [start, report.tell() - start]
+
+    report.close()
+
+    if index_path is not None:
+        index_file = open(index_path, 'w')
+        json.dump(offsets, index_file)
+        index_file.close()
+
+def read_cluster(path, index_path, cluster):
+    """ Returns the part of a report written by write_report that holds
+    the given cluster, using its byte offset index.
+    """
+
+    index_file = open(index_path, 'r')
+    start, length = json.load(index_file)[str(cluster)]
+    index_file.close()
+
+    report = open(path, 'rb')
+    report.seek(start)
+    part = report.read(length)
+    report.close()
+
+    return part.decode('utf-8')
+
+def centroid_similarities(cluster):
+    """ cosine similarity of every document of a cluster to its centroid """
+
+    if len(cluster.documents) == 0:
+        return []
+
+    vectors = [document.vector for document in cluster.documents]
+    if sparse.issparse(vectors[0]):
+        vectors = sparse.vstack(vectors).toarray()
+    else:
+        vectors = np.array(vectors, dtype=float)
+
+    centroid = np.asarray(cluster.centroid, dtype=float)
+
+    norms = np.sqrt((vectors * vectors).sum(axis=1)) * np.linalg.norm(centroid)
+    norms[norms == 0] = 1.0
+
+    return [float(similarity) for similarity in np.dot(vectors, centroid) / norms]
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 
-import json
+import logging
+import numpy as np
+from ann import *
+from corpus import *
+from model import *
+from tokencorpus import *
 from vspace import *
 from lsi import *
 from kmeans import *
+from metrics import *
+
+logger = logging.getLogger(__name__)
 
 class SemanticTweets:
     """ This class is the application controller.
@@ -13,38 +21,162 @@ class SemanticTweets:
     corpus_path = "corpus/corpus.json"
     tweets = []
 
-    def __init__(self, samplesize=50):
-        self.load_tweets(samplesize)
+    # the tweets already tokenized, see open_tokens
+    token_corpus = None
+
+    # the models of the last run
+    vector_space = None
+    lsi = None
+    kmeans = None
+
+    # the K-Means centroids, of the last run or of the opened model
+    centroids = None
+
+    # the documents of the semantic space as unit length rows,
+    # computed on the first similarity query
+    normalized_space = None
+
+    # approximate nearest neighbor index, see build_index
+    index = None
+
+    # instrumentation of the stages, see Metrics
+    metrics = None
 
-    def load_tweets(self, samplesize):
+    def __init__(self, samplesize=None, seed=None, metrics=None, tokens_path=None):
+        """ 'metrics' receives the timings of every stage and the
+        statistics of the K-Means iterations, by default they are logged.
+        With 'tokens_path' the tweets come from a TokenCorpus instead of
+        the corpus file, see open_tokens.
+        """
+        self.metrics = metrics or Metrics([LogSink()])
+
+        if tokens_path is not None:
+            if samplesize is not None:
+                raise Exception('A token corpus is always used whole!')
+            self.open_tokens(tokens_path)
+        else:
+            self.load_tweets(samplesize, seed)
+
+    def load_tweets(self, samplesize=None, seed=None):
         """ This method parses the corpus.json file.
-        It selects 'samplesize' many tweets from the corpus.
-        
-        TODO: do the selection randomly
+        It selects 'samplesize' many tweets from the corpus, randomly
+        (reservoir sampling with the given seed), or all of them if
+        samplesize is None.
+        The corpus is streamed, either as a JSON array or JSON Lines.
         """
 
-        corpus = open(self.corpus_path, 'r')
-        tweets_json = json.loads(corpus.read())
-        corpus.close()
+        with self.metrics.stage('load'):
+            texts = read_tweets(self.corpus_path)
+
+            if samplesize is None:
+                self.tweets = list(texts)
+            else:
+                self.tweets = reservoir_sample(texts, samplesize, seed)
+
+    def open_tokens(self, path):
+        """ Uses the tweets of a TokenCorpus (see utils/preprocess.py),
+        memory-mapped, so run_model skips the tokenizer and builds the
+        matrix straight from their term ids.
+        """
 
-        self.tweets = [t['text'] for t in tweets_json]
+        with self.metrics.stage('load'):
+            self.token_corpus = TokenCorpus(path)
+            self.tweets = self.token_corpus.texts
 
-    def run_model(self):
+    def run_model(self, workers=1, rank=100, clusters=100, rank_rule='gap', energy=0.8,
+                  max_rank=200, candidates=(10, 25, 50, 100, 200), seed=None,
+                  buckets=None, min_df=1, max_df=1.0, max_features=None, n_init=1,
+                  kmeans_workers=None):
         """ This method is in charge of indexing the tweets
         and running the clustering method.
+        'workers' processes are used to tokenize the tweets.
+        'rank' is the number of dimensions of the semantic space and
+        'clusters' the number of clusters. Either can be 'auto':
+            rank     -- the SVD is computed up to max_rank and cut with
+                        rank_rule (and 'energy'), see LSI.select_rank
+            clusters -- the candidate with the best silhouette on a
+                        sample of the documents (drawn from 'seed'),
+                        see KMeans.select_k
+        With 'buckets' the tweets are hashed into that many columns
+        instead of building a vocabulary, see HashingVSpace. Otherwise
+        the vocabulary is pruned with min_df, max_df and max_features,
+        see VSpace.prune.
+        K-Means is run n_init times from different seeds (drawn from
+        'seed') in kmeans_workers processes ('workers' by default) and the
+        best run is kept, see KMeans.cluster. The iterations are only
+        reported when the restarts run in a single process. With
+        clusters='auto' it starts from the centroids of select_k instead,
+        without restarts.
         """
 
-        vector_space = VSpace(self.tweets)
+        if buckets is None:
+            vector_space = VSpace(workers=workers, min_df=min_df, max_df=max_df,
+                                  max_features=max_features)
+        else:
+            vector_space = HashingVSpace(workers=workers, buckets=buckets)
+
+        if self.token_corpus is not None:
+            with self.metrics.stage('vectorize'):
+                vector_space.from_tokens(self.token_corpus.term_index,
+                                         self.token_corpus.tokens, self.token_corpus.offsets)
+        else:
+            with self.metrics.stage('tokenize', workers=workers):
+                chunks = vector_space.tokenize_chunks(self.tweets)
+
+            with self.metrics.stage('vectorize'):
+                vector_space.merge_chunks(chunks)
+
+        if vector_space.pruned is not None:
+            pruned = vector_space.pruned
+            logger.info("vocabulary: %d of %d terms kept (%d below min_df, %d above max_df, "
+                        "%d over max_features)", pruned['kept'], pruned['terms'],
+                        pruned['min_df'], pruned['max_df'], pruned['max_features'])
 
         # print vector_space.term_index
 
         lsi = LSI(vector_space.doc_vectors)
-        lsi.compute_tfidf()
-        lsi.rank_reduced_svd(k=100)  # empirically decide to how many dimensions to reduce
+
+        with self.metrics.stage('tfidf'):
+            lsi.compute_tfidf()
+
+        with self.metrics.stage('svd'):
+            if rank == 'auto':
+                # arpack needs the rank below both dimensions
+                lsi.rank_reduced_svd(k=min(max_rank, min(lsi.vspace.shape) - 1))
+                rank = lsi.select_rank(rank_rule, energy)
+                held = (np.asarray(lsi.sigma_k) ** 2).sum() / lsi.total_energy
+                logger.info("rank: %d (%.2f of the energy)", rank, held)
+            else:
+                lsi.rank_reduced_svd(k=rank)
 
         kmeans = KMeans(lsi.sem_space)
+        centroids = None
 
-        clusters = kmeans.cluster(k=100)
+        if clusters == 'auto':
+            with self.metrics.stage('select_k'):
+                clusters, centroids = kmeans.select_k(candidates, seed=seed)
+                logger.info("clusters: %d", clusters)
+
+        if kmeans_workers is None:
+            kmeans_workers = workers
+
+        # the pool of restarts can't report the iterations
+        if n_init > 1 and kmeans_workers > 1 and centroids is None:
+            callback = None
+        else:
+            callback = self.metrics.iteration
+
+        with self.metrics.stage('kmeans'):
+            clusters = kmeans.cluster(k=clusters, seed=seed, callback=callback,
+                                      n_init=n_init, workers=kmeans_workers,
+                                      centroids=centroids)
+
+        self.vector_space = vector_space
+        self.lsi = lsi
+        self.kmeans = kmeans
+        self.centroids = kmeans.centroids
+        self.normalized_space = None
+        self.index = None
 
         # sort clusters by number of documents
         clusters = sorted(clusters, cmp=lambda x,y: cmp(len(y.documents),len(x.documents)))
@@ -61,3 +193,106 @@ class SemanticTweets:
 #        print "total documents: %d" % total
         
         return clusters
+
+    def save_model(self, path):
+        """ Saves the vocabulary, LSI factors, documents and centroids of
+        the last run to the 'path' directory, see Model.
+        """
+
+        Model(self.vector_space, self.lsi, self.centroids, self.normalized_space).save(path)
+
+    def open_model(self, path):
+        """ Uses a model saved with save_model (memory-mapped) for the
+        similarity queries, instead of running the model. The tweets
+        must be the ones the model was trained with.
+        """
+
+        model = load_model(path)
+
+        self.vector_space = model.vspace
+        self.lsi = model.lsi
+        self.kmeans = None
+        self.centroids = model.centroids
+        self.normalized_space = model.documents
+        self.index = None
+
+        if self.normalized_space is None:
+            # saved without its documents, multiply them out
+            self.lsi.sem_space = np.asarray(self.lsi.sigma_k)[:, np.newaxis] * self.lsi.D_k
+
+    def build_index(self, probes=8):
+        """ Builds the approximate nearest neighbor index used by
+        similar(approximate=True), with the K-Means centroids (of the
+        last run or the opened model) as cells when there are any.
+        See IVFIndex.
+        """
+
+        self.lsi.materialize()
+
+        if self.lsi.sem_space is not None:
+            space = self.lsi.sem_space
+        else:
+            # a model opened with open_model only has its unit length documents
+            space = self.normalized_space.T
+
+        self.index = build_index(space, self.centroids, probes=probes)
+
+    def similar(self, queries, top=10, approximate=False):
+        """ Finds the 'top' tweets most similar (cosine) to a query.
+        A query is either a text, which is projected into the semantic
+        space (LSI fold-in), or the index of a tweet, which is left out
+        of its own results.
+        For a single query it returns a list of (tweet index, similarity)
+        pairs, most similar first, empty for a text without any known
+        term. For a list of queries it returns one such list per query,
+        computed with a single matrix product.
+        With 'approximate' the queries go through the index (see
+        build_index) instead of comparing against every tweet.
+        """
+
+        single = not isinstance(queries, (list, tuple))
+        if single:
+            queries = [queries]
+
+        if self.normalized_space is None:
+            # D_k may be factored after LSI.update()
+            self.lsi.materialize()
+            self.normalized_space = normalize_rows(document_rows(self.lsi.sem_space))
+
+        vectors = np.empty((len(queries), self.normalized_space.shape[1]))
+
+        # project all the texts at once
+        texts = [i for i, query in enumerate(queries) if isinstance(query, basestring)]
+        if texts:
+            counts = self.vector_space.vectorize([queries[i] for i in texts])
+            vectors[texts] = normalize_rows(self.lsi.transform(counts).T)
+
+        indices = [i for i, query in enumerate(queries) if not isinstance(query, basestring)]
+        if indices:
+            vectors[indices] = self.normalized_space[[queries[i] for i in indices]]
+
+        if approximate:
+            if self.index is None:
+                self.build_index()
+
+            # one more result to make room for the query tweet itself
+            results = self.index.search(vectors.T, top + 1)
+            for i in indices:
+                results[i] = [pair for pair in results[i] if pair[0] != queries[i]]
+            results = [result[0:top] for result in results]
+        else:
+            similarities = np.dot(vectors, self.normalized_space.T)
+
+            for i in indices:
+                similarities[i, queries[i]] = -np.inf
+
+            results = [top_similar(row, top) for row in similarities]
+
+        # a text without any known term is nowhere in the space
+        for i in texts:
+            if not vectors[i].any():
+                results[i] = []
+
+        if single:
+            return results[0]
+        return results
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import json
+import os
+import numpy as np
+from array import array
+from vspace import VSpace
+
+class TokenCorpus:
+    """ A corpus already tokenized, as a directory of flat binary files:
+        vocabulary.jsonl -- the terms in id order, one JSON string per line
+        tokens.i32       -- the term ids of all the tweets one after the
+                            other (int32), sorted within every tweet
+        offsets.i64      -- where the ids of every tweet start (int64),
+                            plus the total, so tweet i is
+                            tokens[offsets[i]:offsets[i + 1]]
+        texts.jsonl      -- the texts, one JSON string per line
+        text_offsets.i64 -- where every text starts in texts.jsonl (bytes)
+    The arrays are memory-mapped, so building the matrix from them
+    (VSpace.from_tokens) reads no text and copies nothing.
+    New tweets are appended (see append), the offsets are written last
+    so a tweet only counts once all its data is on disk.
+    """
+
+    path = None
+
+    # terms in id order and <term, id>
+    vocabulary = []
+    term_index = {}
+
+    # memory-mapped arrays, see load()
+    tokens = None
+    offsets = None
+
+    # the texts of the tweets, as a sequence
+    texts = None
+
+    def __init__(self, path):
+        """ Opens the corpus in the 'path' directory, creating an empty
+        one if there is none.
+        """
+
+        self.path = path
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        if not os.path.exists(self.file('offsets.i64')):
+            for name in ('vocabulary.jsonl', 'tokens.i32', 'texts.jsonl'):
+                open(self.file(name), 'wb').close()
+            for name in ('offsets.i64', 'text_offsets.i64'):
+                np.zeros(1, dtype='<i8').tofile(self.file(name))
+
+        vocabulary_file = codecs.open(self.file('vocabulary.jsonl'), 'r', 'utf-8')
+        self.vocabulary = [json.loads(line) for line in vocabulary_file if line.strip()]
+        vocabulary_file.close()
+        self.term_index = dict((term, index) for index, term in enumerate(self.vocabulary))
+
+        self.load()
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def load(self):
+        """ memory-maps the arrays, up to the last complete tweet """
+
+        self.offsets = map_array(self.file('offsets.i64'), '<i8')
+        text_offsets = map_array(self.file('text_offsets.i64'), '<i8')
+
+        # a crash while appending may leave longer files than the offsets
+        docs = min(len(self.offsets), len(text_offsets)) - 1
+        self.offsets = self.offsets[0:docs + 1]
+
+        self.tokens = map_array(self.file('tokens.i32'), '<i4')[0:self.offsets[-1]]
+        self.texts = Texts(self.file('texts.jsonl'), text_offsets[0:docs + 1])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, texts):
+        """ Tokenizes the texts and appends them to the corpus, new terms
+        get the next ids. Returns how many tweets were appended.
+        """
+
+        vspace = VSpace()
+        vspace.term_index = self.term_index
+        terms = len(self.vocabulary)
+
+        ids = array('i')
+        offsets = array('l')
+        lines = []
+        text_offsets = array('l')
+
+        token_end = int(self.offsets[-1])
+        text_end = int(self.texts.offsets[-1])
+
+        for text in texts:
+            ids.extend(sorted(vspace.tokenize_document(text)))
+            offsets.append(token_end + len(ids))
+
+            line = json.dumps(text) + '\n'
+            lines.append(line)
+            text_end += len(line)
+            text_offsets.append(text_end)
+
+        self.vocabulary.extend(sorted(self.term_index, key=self.term_index.get)[terms:])
+
+        # the data first, dropping anything past the last complete tweet
+        write_at(self.file('vocabulary.jsonl'), None,
+                 ''.join(json.dumps(term) + '\n' for term in self.vocabulary[terms:]))
+        write_at(self.file('tokens.i32'), token_end * 4,
+                 np.asarray(ids, dtype='<i4').tostring())
+        write_at(self.file('texts.jsonl'), int(self.texts.offsets[-1]), ''.join(lines))
+
+        # then the offsets, which make the tweets visible
+        write_at(self.file('text_offsets.i64'), len(self.texts.offsets) * 8,
+                 np.asarray(text_offsets, dtype='<i8').tostring())
+        write_at(self.file('offsets.i64'), len(self.offsets) * 8,
+                 np.asarray(offsets, dtype='<i8').tostring())
+
+        self.load()
+
+        return len(offsets)
+
+class Texts:
+    """ Read-only sequence of the texts of a TokenCorpus, every text is
+    read from the file (through a memory map) when it is asked for.
+    """
+
+    def __init__(self, path, offsets):
+        self.data = map_array(path, np.uint8)
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('text index out of range')
+
+        line = self.data[self.offsets[index]:self.offsets[index + 1]].tostring()
+
+        return json.loads(line)
+
+    def __iter__(self):
+        for index in xrange(0, len(self)):
+            yield self[index]
+
+def map_array(path, dtype):
+    """ read-only memory map of a flat binary file, empty files included """
+
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(path, dtype=dtype, mode='r')
+
+def write_at(path, position, data):
+    """ Writes data to a file at 'position' (the end of the file if
+    None), cutting it there first.
+    """
+
+    output = open(path, 'r+b')
+
+    if position is None:
+        output.seek(0, os.SEEK_END)
+    else:
+        output.truncate(position)
+        output.seek(position)
+
+    output.write(data)
+    output.flush()
+    os.fsync(output.fileno())
+    output.close()
+
+def convert_corpus(texts, path, batch_size=10000):
+    """ Appends the texts (any iterable, e.g. read_tweets) to the token
+    corpus in the 'path' directory, in batches. Returns the corpus.
+    """
+
+    corpus = TokenCorpus(path)
+    batch = []
+
+    for text in texts:
+        batch.append(text)
+
+        if len(batch) >= batch_size:
+            corpus.append(batch)
+            batch = []
+
+    if batch:
+        corpus.append(batch)
+
+    return corpus
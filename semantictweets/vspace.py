@@ -1,6 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import json
+import os
+import zlib
+import numpy as np
+from array import array
+from collections import OrderedDict
+from functools import partial
+from multiprocessing import Pool
 from PorterStemmer import PorterStemmer
+from scipy import sparse
+
+# the stop words, at the root of the repository
+STOP_WORDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stop_words.txt')
 
 class VSpace:
     """ This represents a document matrix in which documents are the columns 
@@ -8,70 +20,587 @@ class VSpace:
     it has a non-zero value in the corresponding row.
     """
 
-    # A list of documents
-    doc_vectors = []
+    # A sparse (CSR) matrix of documents x terms
+    doc_vectors = None
 
     # A mapping of <term, index> of all the words in the corpus
-    term_index = []
+    term_index = {}
+
+    # The term ids of every document, a DocumentTokens over the flat ids
+    doc_tokens = []
 
     # A helper class for manipulating document strings
     tokenizer = None
 
-    def __init__(self, docs=[]):
+    # How many processes tokenize the corpus
+    workers = 1
+
+    # Pruning of the vocabulary, see prune()
+    min_df = 1
+    max_df = 1.0
+    max_features = None
+
+    # How many terms the last pruning dropped, and why
+    pruned = None
+
+    def __init__(self, docs=[], workers=1, min_df=1, max_df=1.0, max_features=None):
         self.documents = []
+        self.term_index = {}
+        self.doc_tokens = []
         self.tokenizer = Tokenizer()
+        self.workers = workers
+        self.min_df = min_df
+        self.max_df = max_df
+        self.max_features = max_features
 
         if len(docs) > 0:
             self.build_space(docs)
 
     def build_space(self, docs):
-        """ Create the vector space for the current documents """
+        """ Create the vector space for the current documents.
+        Every document is tokenized once, its terms get ids as they
+        are found and the matrix is built from those ids.
+        With more than one worker the corpus is split in chunks that are
+        tokenized in a process pool, each chunk with its own vocabulary.
+        The vocabularies are merged in chunk order, so the term ids are
+        the same whatever the number of workers.
+        The vocabulary is pruned (see prune) before the matrix is built.
+        """
+
+        self.merge_chunks(self.tokenize_chunks(docs))
+
+    def tokenize_chunks(self, docs):
+        """ Tokenizes the documents, in a process pool with more than one
+        worker. Returns the result of tokenize_chunk for every chunk.
+        """
+
+        return self.map_chunks(tokenize_chunk, docs)
+
+    def map_chunks(self, function, docs):
+        """ Splits the documents in chunks and runs function on every
+        chunk, in a process pool with more than one worker.
+        Returns the results in chunk order.
+        """
+
+        if self.workers > 1:
+            chunk_size = max(1, -(-len(docs) // (self.workers * 4)))
+            chunks = [docs[i:i + chunk_size] for i in xrange(0, len(docs), chunk_size)]
+
+            pool = Pool(self.workers)
+            try:
+                results = pool.map(function, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [function(docs)]
+
+        return results
+
+    def merge_chunks(self, results):
+        """ Merges the vocabularies of the tokenized chunks, in order, and
+        builds the term ids of every document and the sparse matrix.
+        """
+
+        self.term_index = {}
+        global_ids = []
+
+        for vocabulary, ids, indptr in results:
+            # map the local term ids of the chunk to global ones
+            mapping = np.empty(len(vocabulary), dtype=np.intc)
+
+            for local, term in enumerate(vocabulary):
+                index = self.term_index.get(term)
+
+                if index is None:
+                    index = len(self.term_index)
+                    self.term_index[term] = index
+
+                mapping[local] = index
+
+            global_ids.append(mapping[np.frombuffer(ids, dtype=np.intc)])
+
+        indptrs = [np.frombuffer(indptr, dtype=np.intc) for vocabulary, ids, indptr in results]
+        global_ids, indptrs = self.prune(global_ids, indptrs)
+
+        ids, offsets = join_chunks(global_ids, indptrs)
+
+        self.doc_tokens = DocumentTokens(ids, offsets)
+        self.doc_vectors = self.create_matrix(ids, offsets)
+
+    def from_tokens(self, term_index, ids, offsets):
+        """ Builds the space from text already tokenized, e.g. the
+        memory-mapped arrays of a TokenCorpus: the term ids of all the
+        documents one after the other and where each document starts
+        (plus the total). With the ids sorted within every document the
+        matrix uses them as they are, without copying them.
+        The vocabulary is pruned as in build_space.
+        """
+
+        self.term_index = dict(term_index)
+
+        ids, offsets = self.prune([ids], [offsets])
+        ids, offsets = ids[0], offsets[0]
+
+        self.doc_tokens = DocumentTokens(ids, offsets)
+        self.doc_vectors = self.create_matrix(ids, offsets)
+
+    def prune(self, chunk_ids, chunk_indptrs):
+        """ Drops the terms that are in fewer than min_df documents or in
+        more than max_df, and then all but the max_features in the most
+        documents. Either df is a number of documents (int) or a fraction
+        of them (float). The rest of the terms keep their order.
+        Takes and returns the term ids of every chunk and where each of
+        its documents starts, renumbered to the new vocabulary. How many
+        terms were dropped is kept in self.pruned.
+        """
+
+        terms = len(self.term_index)
+        docs = sum(len(indptr) - 1 for indptr in chunk_indptrs)
+
+        # the tokenizer removes repeated terms, so counting the ids
+        # counts the documents of every term
+        doc_freq = np.zeros(terms, dtype=int)
+        for ids in chunk_ids:
+            doc_freq += np.bincount(ids, minlength=terms)
+
+        min_df = self.min_df if isinstance(self.min_df, int) else self.min_df * docs
+        max_df = self.max_df if isinstance(self.max_df, int) else self.max_df * docs
+
+        below = doc_freq < min_df
+        above = doc_freq > max_df
+        keep = ~(below | above)
+
+        over = 0
+        if self.max_features is not None and keep.sum() > self.max_features:
+            # most frequent first, ties by term id
+            ranked = np.argsort(-np.where(keep, doc_freq, -1), kind='mergesort')
+            keep = np.zeros(terms, dtype=bool)
+            keep[ranked[0:self.max_features]] = True
+            over = int((~(below | above)).sum()) - self.max_features
+
+        self.pruned = {'terms': terms,
+                       'kept': int(keep.sum()),
+                       'min_df': int(below.sum()),
+                       'max_df': int((above & ~below).sum()),
+                       'max_features': over}
+
+        if keep.all():
+            return chunk_ids, chunk_indptrs
+
+        mapping = np.cumsum(keep) - 1
+
+        vocabulary = sorted(self.term_index, key=self.term_index.get)
+        self.term_index = dict((term, int(mapping[index]))
+                               for index, term in enumerate(vocabulary) if keep[index])
+
+        pruned_ids, pruned_indptrs = [], []
+
+        for ids, indptr in zip(chunk_ids, chunk_indptrs):
+            kept = keep[ids]
+            # kept ids before every position, the new document offsets
+            before = np.concatenate([[0], np.cumsum(kept)])
+            pruned_ids.append(mapping[ids[kept]].astype(np.intc))
+            pruned_indptrs.append(before[indptr].astype(np.intc))
+
+        return pruned_ids, pruned_indptrs
+
+    def tokenize_document(self, doc):
+        """ Returns the ids of the terms of a document as an array('i').
+        Terms that are not in the index yet get the next free id.
+        """
+
+        ids = array('i')
+
+        for term in self.tokenizer.tokenize(doc):
+            index = self.term_index.get(term)
+
+            if index is None:
+                index = len(self.term_index)
+                self.term_index[term] = index
+
+            ids.append(index)
+
+        return ids
+
+    def create_matrix(self, ids, indptr):
+        """ Create a sparse documents x terms matrix (CSR) from the term
+        ids of the documents, one after the other, and the offsets where
+        each document starts (plus the total length).
+        Only the non-zero entries are stored, tweets have only a handful
+        of terms so a dense row per tweet would be almost all zeros.
+        """
+
+        # simple word count, use floats for LSI
+        data = np.ones(len(ids))
+
+        matrix = sparse.csr_matrix((data, ids, indptr),
+                                   shape=(len(indptr) - 1, len(self.term_index)))
+        # add up repeated terms, if any
+        matrix.sum_duplicates()
+
+        return matrix
+
+    def vectorize(self, docs, add_terms=False):
+        """ Creates the sparse documents x terms matrix (CSR) of new
+        documents with the current vocabulary. Terms that are not in the
+        vocabulary are ignored, or appended to it with 'add_terms' (they
+        get the next ids, so they are the last columns of the matrix).
+        """
+
+        ids = array('i')
+        indptr = array('i', [0])
+
+        for doc in docs:
+            if add_terms:
+                ids.extend(self.tokenize_document(doc))
+            else:
+                for term in self.tokenizer.tokenize(doc):
+                    index = self.term_index.get(term)
+
+                    if index is not None:
+                        ids.append(index)
+
+            indptr.append(len(ids))
+
+        return self.create_matrix(np.frombuffer(ids, dtype=np.intc),
+                                  np.frombuffer(indptr, dtype=np.intc))
+
+    def column_terms(self, columns):
+        """ the terms of every given column of the matrix, as lists """
+
+        vocabulary = sorted(self.term_index, key=self.term_index.get)
+
+        return [[vocabulary[column]] for column in columns]
+
+class HashingVSpace(VSpace):
+    """ A VSpace without a vocabulary (the hashing trick).
+    Every term goes to one of a fixed number of 'buckets' (the columns
+    of the matrix) by a hash of it, so memory doesn't grow with every new
+    hashtag, typo or URL of the stream, and chunks of documents can be
+    vectorized anywhere with nothing to merge but the matrices.
+    The hash also gives every term a sign, so the terms sharing a bucket
+    tend to cancel out instead of piling up (Weinberger et al.), the
+    counts of the matrix are signed.
+    A column can't be turned back into its terms, so a reverse map is
+    kept for a sample: the first 'sample_terms' distinct terms seen.
+    """
+
+    buckets = 2 ** 18
+
+    # <term, bucket> for the sampled terms in the order they were seen,
+    # see column_terms
+    term_buckets = OrderedDict()
+    sample_terms = 10000
+
+    def __init__(self, docs=[], workers=1, buckets=2 ** 18, sample_terms=10000):
+        self.buckets = buckets
+        self.sample_terms = sample_terms
+        self.term_buckets = OrderedDict()
+
+        VSpace.__init__(self, docs, workers)
+
+    def tokenize_chunks(self, docs):
+        """ Hashes the documents, in a process pool with more than one
+        worker. Returns the result of hash_chunk for every chunk.
+        """
+
+        return self.map_chunks(partial(hash_chunk, buckets=self.buckets,
+                                       sample_terms=self.sample_terms), docs)
+
+    def merge_chunks(self, results):
+        """ Joins the buckets of the hashed chunks, in order, into one matrix,
+        and adds their terms to the sample while it has room.
+        """
+
+        chunk_ids, chunk_signs, chunk_indptrs = [], [], []
+
+        for term_buckets, ids, signs, indptr in results:
+            for term, bucket in term_buckets:
+                self.sample_term(bucket, term)
+
+            chunk_ids.append(np.frombuffer(ids, dtype=np.intc))
+            chunk_signs.append(np.frombuffer(signs, dtype=np.int8))
+            chunk_indptrs.append(np.frombuffer(indptr, dtype=np.intc))
+
+        ids, offsets = join_chunks(chunk_ids, chunk_indptrs)
+        signs = np.concatenate(chunk_signs)
+
+        self.doc_tokens = DocumentTokens(ids, offsets)
+        self.doc_vectors = self.create_matrix(ids, offsets, signs)
+
+    def from_tokens(self, term_index, ids, offsets):
+        """ Builds the space from text already tokenized (see
+        VSpace.from_tokens), every term of the vocabulary is hashed once.
+        The terms are sampled in id order.
+        """
+
+        vocabulary = sorted(term_index, key=term_index.get)
+        buckets = np.empty(len(vocabulary), dtype=np.intc)
+        signs = np.empty(len(vocabulary), dtype=np.int8)
+
+        for index, term in enumerate(vocabulary):
+            buckets[index], signs[index] = self.hash_term(term)
+            self.sample_term(int(buckets[index]), term)
 
-        self.term_index = self.get_word_index(docs)
-        self.doc_vectors = [self.create_vector(document) for document in docs]
+        hashed = buckets[ids]
 
-    def get_word_index(self, docs):
-        # create a single string with all the documents
-        docs_string = " ".join(docs)
+        self.doc_tokens = DocumentTokens(hashed, offsets)
+        self.doc_vectors = self.create_matrix(hashed, offsets, signs[ids])
+
+    def hash_documents(self, docs, sample=True):
+        """ Returns the buckets of the terms of all the documents one
+        after the other, as array('i'), their signs, as array('b'), and
+        where each document starts. With 'sample' the terms are added
+        to the reverse map.
+        """
+
+        ids = array('i')
+        signs = array('b')
+        indptr = array('i', [0])
+
+        for doc in docs:
+            for term in self.tokenizer.tokenize(doc):
+                bucket, sign = self.hash_term(term)
+
+                ids.append(bucket)
+                signs.append(sign)
+
+                if sample:
+                    self.sample_term(bucket, term)
+
+            indptr.append(len(ids))
+
+        return ids, signs, indptr
+
+    def hash_term(self, term):
+        """ Returns the bucket and the sign (1 or -1) of a term.
+        The low bits of the (32 bit) hash choose the bucket and the
+        highest one the sign, the hash is the same in every process.
+        """
 
-        # get a nice list of terms without stop words
-        vocabulary = self.tokenizer.tokenize(docs_string)
+        if isinstance(term, unicode):
+            term = term.encode('utf-8')
 
-        doc_index = {}
-        index = 0
+        value = zlib.crc32(term) & 0xffffffff
 
-        # create a map of every word to a specific dimension of the "full document" space
-        for word in vocabulary:
-            doc_index[word] = index
-            index += 1
+        return value % self.buckets, 1 if value < 0x80000000 else -1
+
+    def sample_term(self, bucket, term):
+        """ adds a term to the reverse map, if there is room for it """
+
+        if len(self.term_buckets) < self.sample_terms and term not in self.term_buckets:
+            self.term_buckets[term] = bucket
+
+    def tokenize_document(self, doc):
+        """ Returns the buckets of the terms of a document as an array('i') """
+
+        ids, signs, indptr = self.hash_documents([doc])
+
+        return ids
+
+    def create_matrix(self, ids, indptr, signs=None):
+        """ Create the sparse documents x buckets matrix (CSR) from the
+        buckets of the terms of the documents and their signs, the terms
+        of a document that cancel each other out leave no entry.
+        """
+
+        if signs is None:
+            data = np.ones(len(ids))
+        else:
+            data = np.asarray(signs, dtype=float)
+
+        matrix = sparse.csr_matrix((data, ids, indptr),
+                                   shape=(len(indptr) - 1, self.buckets))
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+
+        return matrix
+
+    def vectorize(self, docs, add_terms=False):
+        """ Creates the sparse documents x buckets matrix (CSR) of new
+        documents. Every term has a bucket, so none is ignored, with
+        'add_terms' new terms are also added to the sample.
+        """
+
+        ids, signs, indptr = self.hash_documents(docs, sample=add_terms)
+
+        return self.create_matrix(np.frombuffer(ids, dtype=np.intc),
+                                  np.frombuffer(indptr, dtype=np.intc),
+                                  np.frombuffer(signs, dtype=np.int8))
+
+    def column_terms(self, columns):
+        """ the sampled terms of every given bucket, as lists """
+
+        bucket_terms = {}
+        for term, bucket in self.term_buckets.iteritems():
+            bucket_terms.setdefault(bucket, []).append(term)
+
+        return [bucket_terms.get(column, []) for column in columns]
+
+class DocumentTokens:
+    """ The term ids of every document as a read-only sequence over the
+    flat ids and the offsets where each document starts, the array of a
+    document is only sliced when it is asked for.
+    """
 
-        return doc_index
+    def __init__(self, ids, offsets):
+        self.ids = ids
+        self.offsets = offsets
 
-    def create_vector(self, doc):
-        """ create a term vector for the current document """
+    def __len__(self):
+        return len(self.offsets) - 1
 
-        # initialize in zero, use floats
-        vector = [0.0] * len(self.term_index) 
-        terms = self.tokenizer.tokenize(doc)
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('document index out of range')
 
-        for term in terms:
-            # simple word count, use floats for LSI
-            vector[self.term_index[term]] += 1.0 
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
 
-        return vector
+    def __iter__(self):
+        for index in xrange(0, len(self)):
+            yield self[index]
+
+def join_chunks(chunk_ids, chunk_indptrs):
+    """ Joins the term ids of consecutive chunks of documents and the
+    offsets where each document starts (plus the total), so the whole
+    corpus is one matrix and one DocumentTokens.
+    """
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    end = 0
+
+    for indptr in chunk_indptrs:
+        offsets.append(indptr[1:].astype(np.int64) + end)
+        end += int(indptr[-1])
+
+    return np.concatenate(chunk_ids), np.concatenate(offsets)
+
+def hash_chunk(docs, buckets=2 ** 18, sample_terms=10000):
+    """ Hashes a list of documents, this is what every worker of
+    HashingVSpace runs.
+    Returns the sampled terms with their buckets, the buckets and signs
+    of the terms of all the documents one after the other and where each
+    document starts.
+    """
+
+    vspace = HashingVSpace(buckets=buckets, sample_terms=sample_terms)
+    ids, signs, indptr = vspace.hash_documents(docs)
+
+    return vspace.term_buckets.items(), ids, signs, indptr
+
+def tokenize_chunk(docs):
+    """ Tokenizes a list of documents with a vocabulary of its own,
+    this is what every worker of VSpace runs.
+    Returns the vocabulary (the terms in id order), the term ids of all
+    the documents one after the other and where each document starts.
+    """
+
+    vspace = VSpace()
+    ids = array('i')
+    indptr = array('i', [0])
+
+    for doc in docs:
+        ids.extend(vspace.tokenize_document(doc))
+        indptr.append(len(ids))
+
+    vocabulary = sorted(vspace.term_index, key=vspace.term_index.get)
+
+    return vocabulary, ids, indptr
+
+class StemCache:
+    """ Bounded LRU cache of <word, stem>.
+    Tweets have a very skewed vocabulary, so most words are stemmed over
+    and over again. The least recently used stems are dropped once the
+    cache holds 'size' words. It can be saved to a file and loaded back
+    to skip stemming the known vocabulary on a warm restart.
+    """
+
+    size = 100000
+
+    # cache lookups that found (hits) or didn't find (misses) the word
+    hits = 0
+    misses = 0
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.stems = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, word):
+        """ returns the stem of the word, or None if it is not cached """
+
+        stem = self.stems.pop(word, None)
+
+        if stem is None:
+            self.misses += 1
+            return None
+
+        # re-insert it as the most recently used
+        self.stems[word] = stem
+        self.hits += 1
+
+        return stem
+
+    def put(self, word, stem):
+        self.stems[word] = stem
+        self.shrink()
+
+    def resize(self, size):
+        self.size = size
+        self.shrink()
+
+    def shrink(self):
+        """ drop the least recently used stems above the size """
+        while len(self.stems) > self.size:
+            self.stems.popitem(last=False)
+
+    def clear(self):
+        self.stems.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / float(lookups)
+
+    def save(self, path):
+        """ writes the cached stems, least recently used first """
+        cache_file = open(path, 'w')
+        json.dump(self.stems.items(), cache_file)
+        cache_file.close()
+
+    def load(self, path):
+        """ adds the stems saved with save() """
+        cache_file = open(path, 'r')
+        for word, stem in json.load(cache_file):
+            self.stems[word] = stem
+        cache_file.close()
+        self.shrink()
+
+    def __len__(self):
+        return len(self.stems)
 
 class Tokenizer:
     """ Helper class for tokenizing document space and removing stop words """
 
     corpus = None
     terms = []
-    stop_words = []
+    stop_words = set()
     stemmer = None
 
+    # stems shared by every tokenizer
+    stem_cache = StemCache()
+
     def __init__(self):
 
         # read stop words from file
-        self.stop_words = open('stop_words.txt', 'r').read().split()
+        self.stop_words = set(open(STOP_WORDS_PATH, 'r').read().split())
         self.stemmer = PorterStemmer()
 
     def tokenize(self, docs_string):
@@ -99,7 +628,18 @@ class Tokenizer:
         self.corpus = self.corpus.replace("\s+", " ")
 
     def remove_stop_words(self):
-        self.terms = [self.stemmer.stem(term,0,len(term)-1) for term in self.terms if term not in self.stop_words]
+        self.terms = [self.stem(term) for term in self.terms if term not in self.stop_words]
+
+    def stem(self, term):
+        """ stems a term, going through the shared stem cache """
+
+        stem = self.stem_cache.get(term)
+
+        if stem is None:
+            stem = self.stemmer.stem(term,0,len(term)-1)
+            self.stem_cache.put(term, stem)
+
+        return stem
 
     def remove_duplicates(self):
         """ remove duplicated terms in the list """
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+""" Run from the repository with: python -m unittest discover tests """
+
+import os
+import sys
+import unittest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(root, 'semantictweets'))
+sys.path.append(os.path.join(root, 'lib'))
+
+import numpy as np
+from scipy import sparse
+from kmeans import KMeans
+
+def blobs(docs=2000, dimensions=20, centers=8, seed=0):
+    """ dimensions x docs semantic space with a few clusters """
+
+    random_state = np.random.RandomState(seed)
+    means = 3 * random_state.standard_normal((centers, dimensions))
+    labels = random_state.randint(centers, size=docs)
+
+    return (means[labels] + random_state.standard_normal((docs, dimensions))).T
+
+class HamerlyTest(unittest.TestCase):
+    """ algorithm='hamerly' must give the same clustering as 'lloyd' """
+
+    def assertSameClustering(self, space, **parameters):
+        lloyd = KMeans(space).fit(algorithm='lloyd', **parameters)
+        hamerly = KMeans(space).fit(algorithm='hamerly', **parameters)
+
+        self.assertTrue((lloyd.labels == hamerly.labels).all())
+        self.assertTrue(np.allclose(lloyd.centroids, hamerly.centroids))
+        self.assertEqual(lloyd.iterations, hamerly.iterations)
+
+        # every similarity is either computed or skipped
+        self.assertTrue(hamerly.skipped >= 0)
+        self.assertEqual(hamerly.computations + hamerly.skipped, lloyd.computations)
+
+        return hamerly
+
+    def test_same_as_lloyd(self):
+        space = blobs()
+
+        for seed in xrange(0, 5):
+            for init in ('k-means++', 'random'):
+                self.assertSameClustering(space, k=12, max_iter=20, init=init, seed=seed)
+
+    def test_skips_comparisons(self):
+        hamerly = self.assertSameClustering(blobs(), k=8, max_iter=20, seed=0)
+        self.assertTrue(hamerly.skipped > 0)
+
+    def test_ties(self):
+        # every document is there three times
+        space = np.hstack([blobs(docs=300, seed=1)] * 3)
+
+        for seed in xrange(0, 3):
+            self.assertSameClustering(space, k=10, max_iter=20, seed=seed)
+
+    def test_empty_clusters(self):
+        # random centroids far from the few documents leave clusters empty
+        space = blobs(docs=60, dimensions=5, centers=3, seed=2)
+
+        for seed in xrange(0, 3):
+            self.assertSameClustering(space, k=20, max_iter=20, init='random', seed=seed)
+
+    def test_sparse(self):
+        space = sparse.csr_matrix(np.maximum(blobs(seed=3), 0))
+
+        for seed in xrange(0, 3):
+            self.assertSameClustering(space, k=10, max_iter=20, seed=seed)
+
+if __name__ == '__main__':
+    unittest.main()
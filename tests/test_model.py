@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+""" Run from the repository with: python -m unittest discover tests """
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(root, 'semantictweets'))
+sys.path.append(os.path.join(root, 'lib'))
+
+import numpy as np
+from semtweets import SemanticTweets
+from tokencorpus import TokenCorpus
+
+TOPICS = [u'football goal match league striker keeper',
+          u'election senate vote campaign ballot debate',
+          u'weather storm rain snow forecast thunder',
+          u'movie actor premiere cinema director trailer']
+
+def topic_tweets(tweets=200, seed=0):
+    """ short tweets, each with a few words of one of the topics """
+
+    random_state = np.random.RandomState(seed)
+    words = [topic.split() for topic in TOPICS]
+
+    return [u' '.join(random_state.choice(words[t], 3))
+            for t in random_state.randint(len(TOPICS), size=tweets)]
+
+class ModelTest(unittest.TestCase):
+    """ a saved model answers the queries like the one that was run """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_hashing_from_tokens(self):
+        TokenCorpus(os.path.join(self.path, 'tokens')).append(topic_tweets())
+
+        tweets = SemanticTweets(tokens_path=os.path.join(self.path, 'tokens'))
+        tweets.run_model(rank=3, clusters=4, seed=0, buckets=2 ** 10)
+        tweets.save_model(os.path.join(self.path, 'model'))
+
+        opened = SemanticTweets(tokens_path=os.path.join(self.path, 'tokens'))
+        opened.open_model(os.path.join(self.path, 'model'))
+
+        self.assertEqual(dict(opened.vector_space.term_buckets),
+                         dict(tweets.vector_space.term_buckets))
+
+        queries = [u'storm and rain', u'the senate vote', 5]
+        # the same tweets repeat, so compare the similarities (ties may swap)
+        for expected, result in zip(tweets.similar(queries, top=5), opened.similar(queries, top=5)):
+            self.assertTrue(np.allclose([similarity for index, similarity in expected],
+                                        [similarity for index, similarity in result]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+""" Benchmarks the stages of the model (VSpace, LSI.compute_tfidf,
+LSI.rank_reduced_svd and KMeans.cluster) on seeded synthetic corpora.
+Every stage is timed and its peak memory (RSS) is sampled while it runs.
+The results are written as JSON to plot scaling curves or to compare
+two versions of the code.
+
+Usage:
+    ./benchmark.py --sizes 1000,10000 --ranks 50,100 --clusters 10,100 --output bench.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(root, 'semantictweets'))
+sys.path.append(os.path.join(root, 'lib'))
+
+import numpy as np
+import scipy
+from vspace import VSpace
+from lsi import LSI
+from kmeans import KMeans
+from metrics import PeakMemory, cpu_time, current_rss
+
+logger = logging.getLogger('benchmark')
+
+def synthetic_corpus(size, vocabulary=20000, topics=20, topic_share=0.5,
+                     mean_length=12, zipf=1.1, seed=0):
+    """ Generates 'size' tweets and the topic planted in each one.
+    Words follow a Zipfian distribution over a made-up vocabulary, each
+    topic owns a slice of it. A tweet draws about 'topic_share' of its
+    words from its topic and the rest from the whole vocabulary, its
+    length is Poisson distributed around 'mean_length' words.
+    """
+
+    random_state = np.random.RandomState(seed)
+    words = made_up_words(vocabulary, random.Random(seed))
+
+    ranks = np.arange(1, vocabulary + 1)
+    background = 1.0 / ranks ** zipf
+    background /= background.sum()
+
+    # every topic gets a random slice of the vocabulary, with its own zipf
+    topic_words = np.array_split(random_state.permutation(vocabulary), topics)
+    topic_weights = []
+    for slice_words in topic_words:
+        weights = 1.0 / np.arange(1, len(slice_words) + 1) ** zipf
+        topic_weights.append(weights / weights.sum())
+
+    labels = random_state.randint(topics, size=size)
+    lengths = np.clip(random_state.poisson(mean_length, size=size), 1, 35)
+
+    tweets = []
+    for label, length in zip(labels, lengths):
+        from_topic = random_state.binomial(length, topic_share)
+        ids = np.concatenate([
+            random_state.choice(topic_words[label], from_topic, p=topic_weights[label]),
+            random_state.choice(vocabulary, length - from_topic, p=background)])
+        random_state.shuffle(ids)
+        tweets.append(u' '.join(words[i] for i in ids))
+
+    return tweets, labels
+
+def made_up_words(count, random_state):
+    """ 'count' distinct pronounceable lowercase words """
+
+    consonants = 'bcdfghjklmnprstvwz'
+    vowels = 'aeiou'
+    words = set()
+
+    while len(words) < count:
+        syllables = random_state.randint(2, 4)
+        words.add(u''.join(random_state.choice(consonants) + random_state.choice(vowels)
+                           for i in xrange(0, syllables)))
+
+    return sorted(words)
+
+def measure(stage, results, config, function, *args, **kwargs):
+    """ runs function(*args, **kwargs) and appends its timing to results """
+
+    monitor = PeakMemory()
+    start_rss = current_rss()
+    monitor.start()
+
+    start_wall = time.time()
+    start_cpu = cpu_time()
+    value = function(*args, **kwargs)
+    cpu = cpu_time() - start_cpu
+    wall = time.time() - start_wall
+
+    peak = monitor.stop()
+
+    result = dict(config)
+    result.update({'stage': stage,
+                   'wall_seconds': wall,
+                   'cpu_seconds': cpu,
+                   'peak_rss_mb': peak / 1048576.0,
+                   'peak_rss_increase_mb': (peak - start_rss) / 1048576.0})
+    results.append(result)
+
+    logger.info("%s %d docs: %.3fs, peak %.1fMB", stage, result['size'],
+                result['wall_seconds'], result['peak_rss_mb'])
+
+    return value, result
+
+def purity(cluster_labels, topics):
+    """ fraction of tweets whose cluster's most common topic is their own """
+
+    total = 0
+    for cluster in np.unique(cluster_labels):
+        total += np.bincount(topics[cluster_labels == cluster]).max()
+
+    return total / float(len(topics))
+
+def run(sizes, ranks, clusters, tfidf_scheme='raw', solver=None, max_iter=10,
+        init='k-means++', algorithm='lloyd', seed=0):
+    """ runs every stage for every combination of the parameters """
+
+    results = []
+
+    for size in sizes:
+        tweets, topics = synthetic_corpus(size, seed=seed)
+        config = {'size': size}
+
+        vspace, result = measure('vspace', results, config, VSpace, tweets)
+        result['terms'] = len(vspace.term_index)
+
+        lsi = LSI(vspace.doc_vectors)
+        measure('tfidf', results, config, lsi.compute_tfidf, tfidf_scheme)
+
+        for rank in ranks:
+            config = {'size': size, 'rank': rank}
+            measure('svd', results, config, lsi.rank_reduced_svd, k=rank, solver=solver, seed=seed)
+
+            kmeans = KMeans(lsi.sem_space)
+
+            for k in clusters:
+                config = {'size': size, 'rank': rank, 'clusters': k}
+                measure('kmeans', results, config, kmeans.cluster,
+                        k=k, max_iter=max_iter, init=init, seed=seed, algorithm=algorithm)
+                results[-1]['purity'] = purity(kmeans.labels, topics)
+                results[-1]['iterations'] = kmeans.iterations
+                results[-1]['skipped'] = kmeans.skipped
+
+    return results
+
+def parse_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the model on synthetic tweets.')
+    parser.add_argument('--sizes', type=parse_list, default=[1000, 5000, 20000])
+    parser.add_argument('--ranks', type=parse_list, default=[100])
+    parser.add_argument('--clusters', type=parse_list, default=[100])
+    parser.add_argument('--tfidf', default='raw')
+    parser.add_argument('--solver', default=None)
+    parser.add_argument('--max-iter', type=int, default=10)
+    parser.add_argument('--init', default='k-means++')
+    parser.add_argument('--algorithm', default='lloyd')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    results = run(args.sizes, args.ranks, args.clusters, args.tfidf, args.solver,
+                  args.max_iter, args.init, args.algorithm, args.seed)
+
+    report = {'environment': {'python': platform.python_version(),
+                              'numpy': np.__version__,
+                              'scipy': scipy.__version__,
+                              'platform': platform.platform()},
+              'parameters': vars(args),
+              'results': results}
+
+    output = open(args.output, 'w')
+    json.dump(report, output, indent=2)
+    output.close()
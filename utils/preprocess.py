@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+""" Converts a corpus of tweets (a JSON array or JSON Lines, like
+corpus/corpus.json) into a binary token corpus: the vocabulary, the
+offsets of every tweet and the flat term ids, see TokenCorpus.
+The tweets are appended when the token corpus already exists.
+Use it with SemanticTweets(tokens_path=...) to skip the tokenizer.
+
+Usage:
+    ./preprocess.py ../corpus/corpus.json ../corpus/tokens
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(root, 'semantictweets'))
+sys.path.append(os.path.join(root, 'lib'))
+
+from corpus import read_tweets
+from tokencorpus import TokenCorpus, convert_corpus
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a corpus of tweets into a binary token corpus.')
+    parser.add_argument('corpus', help='JSON array or JSON Lines of tweets')
+    parser.add_argument('output', help='token corpus directory')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    log = logging.getLogger('preprocess')
+
+    before = len(TokenCorpus(args.output))
+    corpus = convert_corpus(read_tweets(args.corpus), args.output, args.batch_size)
+
+    log.info("%d tweets appended, %d in total, %d terms, %d tokens",
+             len(corpus) - before, len(corpus), len(corpus.vocabulary), len(corpus.tokens))
@@ -1,34 +1,71 @@
 #!/usr/bin/env python
+""" Stores the tweets of the Twitter stream in MongoDB (corpus.tweets),
+in a JSON Lines corpus file with --output or in a binary token corpus
+(see utils/preprocess.py) with --tokens.
+The tweets go through an ingestion Pipeline: they are read in a thread
+into a bounded queue and written in batches, see semantictweets/ingest.py.
+With --input a JSON Lines file is replayed instead of the stream, to run
+it locally without Twitter.
 
-import tweetstream as ts
-import pymongo as pm
+Usage:
+    ./twitter_client.py <user> <password> [<space separated search terms>]
+    ./twitter_client.py --input tweets.jsonl --output corpus.jsonl
+"""
+
+import argparse
+import logging
+import os
 import sys
 
-username = 'user'
-password = 'pass'
-words = []
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(root, 'semantictweets'))
+sys.path.append(os.path.join(root, 'lib'))
+
+from ingest import Pipeline, MongoSink, JSONLinesSink, TokenSink, replay
+
 location = ['-124.4','32.5','-66','47.5'] # from the US (california to maine) to try to restrict to English tweets
 
-if len(sys.argv) < 3:
-    sys.exit("Usage: " + sys.argv[0] + " <user> <password> [<space separated search terms>]" )
-else:
-    username = sys.argv[1]
-    password = sys.argv[2]
-    words = None
-
-    if len(sys.argv) > 3:
-        words = []
-        for i in range(3,len(sys.argv)):
-            words.append(sys.argv[i])
-
-    print words
-
-connection = pm.Connection()
-db = connection.corpus
-
-with ts.FilterStream(username, password, locations=location, track=words) as stream:
-    for tweet in stream:
-#        print tweet['user']['screen_name'] + ': ' + tweet['text'], "\n"
-#        print "----" * 4
-        db.tweets.save(tweet)
-        
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Store the tweets of the Twitter stream.')
+    parser.add_argument('user', nargs='?')
+    parser.add_argument('password', nargs='?')
+    parser.add_argument('words', nargs='*', help='search terms')
+    parser.add_argument('--input', help='replay a JSON Lines file instead of the stream')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds between replayed tweets')
+    parser.add_argument('--output', help='append to a JSON Lines file instead of MongoDB')
+    parser.add_argument('--tokens', help='append to a binary token corpus instead of MongoDB')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--flush-seconds', type=float, default=1.0)
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--report-seconds', type=float, default=10.0)
+    args = parser.parse_args()
+
+    if args.input is None and args.password is None:
+        parser.error('<user> and <password> are needed to read the stream')
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    log = logging.getLogger('twitter_client')
+
+    if args.tokens is not None:
+        sink = TokenSink(args.tokens)
+    elif args.output is not None:
+        sink = JSONLinesSink(args.output)
+    else:
+        import pymongo as pm
+        connection = pm.Connection()
+        sink = MongoSink(connection.corpus.tweets)
+
+    pipeline = Pipeline(sink, args.batch_size, args.flush_seconds, args.queue_size,
+                        args.retries, report_seconds=args.report_seconds)
+
+    if args.input is not None:
+        pipeline.run(replay(args.input, args.delay))
+    else:
+        import tweetstream as ts
+
+        words = args.words or None
+        log.info("search terms: %s", ', '.join(words) if words else 'none')
+
+        with ts.FilterStream(args.user, args.password, locations=location, track=words) as stream:
+            pipeline.run(stream)